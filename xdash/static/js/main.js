@@ -192,7 +192,22 @@
       socket = new WebSocket(uri);
       that = this;
       socket.onopen = function(evt) {
-        return console.log("Connected to " + uri);
+        var host;
+        console.log("Connected to " + uri);
+        return socket.send(JSON.stringify({
+          subscribe: (function() {
+            var _i, _len, _ref, _results;
+            _ref = that.config.list();
+            _results = [];
+            for (_i = 0, _len = _ref.length; _i < _len; _i++) {
+              host = _ref[_i];
+              _results.push({
+                host: host.hostname
+              });
+            }
+            return _results;
+          })()
+        }));
       };
       return socket.onmessage = function(evt) {
         return that.handleWebsocketMessage(evt.data);
@@ -213,8 +228,23 @@
     };
 
     Application.prototype.handleWebsocketMessage = function(data) {
-      var escapedHostname, hostname, packet, rx, time, tx, usedMemory;
-      packet = $.parseJSON(data);
+      var message, packet, packets, _i, _len, _ref, _results;
+      message = $.parseJSON(data);
+      packets = (_ref = message.snapshot) != null ? _ref : message.batch;
+      if (packets != null) {
+        _results = [];
+        for (_i = 0, _len = packets.length; _i < _len; _i++) {
+          packet = packets[_i];
+          _results.push(this.handlePacket(packet));
+        }
+        return _results;
+      } else {
+        return this.handlePacket(message);
+      }
+    };
+
+    Application.prototype.handlePacket = function(packet) {
+      var escapedHostname, hostname, rx, time, tx, usedMemory;
       hostname = packet.host;
       escapedHostname = hostname.replace(/\./g, "\\.");
       time = new Date().getTime();
@@ -0,0 +1,283 @@
+"""
+End-to-end load test of the aggregator.
+
+Runs `aggregator.Server` with a `Publisher`, a redis module writing to an
+in-process fake and a websocket module feeding simulated consumers, driven
+by simulated reporters (`network.Client`) in a forked process so they don't
+count towards the aggregator's CPU time.
+
+    python -m xstats.bench.aggregator --reporters 500 --modules 4 \\
+        --interval 1 --duration 30 --output results.json
+
+Latency is measured from a reporter sending a packet to a websocket
+consumer receiving it, on a sample of the frames. Results are per second
+over the measured period, "cpu" is the aggregator's CPU use in percent of
+a core and "rss" its peak RSS in KB.
+"""
+
+from gevent import monkey; monkey.patch_socket()
+
+import argparse
+import os
+import random
+import resource
+import time
+
+import gevent
+import ujson
+
+from xstats.bench.shared import header
+from xstats.daemon import aggregator, network
+from xstats.daemon.metrics import registry
+from xstats.daemon.shared import setup_logging
+
+class FakeRedis(object):
+    """Keeps hashes and lists in memory, enough for `RedisModule`"""
+
+    def __init__(self):
+        self.hashes   = {}
+        self.lists    = {}
+        self.commands = 0
+
+    def pipeline(self, transaction = True):
+        return FakePipeline(self)
+
+    def hmset(self, key, data):
+        self.hashes.setdefault(key, {}).update(data)
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def ltrim(self, key, start, end):
+        values = self.lists.get(key, [])
+        self.lists[key] = values[start:end + 1 if end != -1 else None]
+
+class FakePipeline(object):
+    """Queues commands until `execute`, like a redis pipeline"""
+
+    def __init__(self, redis):
+        self.redis  = redis
+        self.queued = []
+
+    def __getattr__(self, command):
+        return lambda *args: self.queued.append((command, args))
+
+    def execute(self):
+        for command, args in self.queued:
+            getattr(self.redis, command)(*args)
+
+        self.redis.commands += len(self.queued)
+        self.queued = []
+
+class FakeWebSocket(object):
+    """
+    Websocket of a simulated consumer, decodes every `sampleEvery`th frame
+    to measure latency
+    """
+
+    def __init__(self, latencies, sampleEvery = 10):
+        self.latencies   = latencies
+        self.sampleEvery = sampleEvery
+        self.frames      = 0
+
+    def send(self, frame):
+        self.frames += 1
+
+        if self.frames % self.sampleEvery:
+            return
+
+        now    = time.time()
+        packet = ujson.loads(frame)
+
+        for entry in packet.get("batch", (packet, )):
+            sent = entry.get("data", {}).get("sent")
+            if sent is not None:
+                self.latencies.append(now - sent)
+
+    def receive(self):
+        return None
+
+    def close(self):
+        pass
+
+class BenchWebsocketModule(aggregator.WebsocketModule):
+    """`WebsocketModule` without the HTTP server, clients are added directly"""
+
+    def _start(self):
+        pass
+
+    def addConsumer(self, ws):
+        client = aggregator.WebsocketClient(ws, ("bench", len(self.clients)),
+                                            self.queueSize, self.slowConsumer)
+        self.clients.add(client)
+        self.index.clear()
+
+        return client
+
+def runReporters(options):
+    """Run the simulated reporters until the benchmark is over"""
+
+    until = time.time() + options.warmup + options.duration
+
+    def reporter(index):
+        client = network.Client(("127.0.0.1", options.port), options.protocols)
+        client.connect()
+
+        host = "bench-{}".format(index)
+
+        # Spread the reporters over the interval
+        gevent.sleep(random.uniform(0, options.interval))
+
+        while time.time() < until:
+            entries = [
+                {"module": "module-{}".format(module), "data": dict(
+                    [("key-{}".format(key), random.random())
+                        for key in xrange(options.keys)] +
+                    [("sent", time.time())]
+                )} for module in xrange(options.modules)
+            ]
+
+            if options.unbatched:
+                for entry in entries:
+                    entry.update(host = host, timestamp = int(time.time()))
+                    client.send(entry)
+            else:
+                client.send({"batch": entries, "host": host,
+                             "timestamp": int(time.time())})
+
+            gevent.sleep(options.interval)
+
+    gevent.joinall([gevent.spawn(reporter, index)
+                        for index in xrange(options.reporters)])
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def usage():
+    """CPU seconds (user + system) and peak RSS in KB of this process"""
+
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss
+
+def run(options):
+    """
+    Run the benchmark
+
+    :returns: Results dictionary
+    """
+
+    # Fork the reporters before anything is listening
+    pid = gevent.fork()
+    if pid == 0:
+        try:
+            runReporters(options)
+        finally:
+            os._exit(0)
+
+    latencies = []
+
+    publisher = aggregator.Publisher()
+
+    redisModule       = aggregator.RedisModule(history = options.history)
+    redisModule.redis = fakeRedis = FakeRedis()
+    publisher.addModule(redisModule)
+
+    websocketModule = BenchWebsocketModule()
+    publisher.addModule(websocketModule)
+
+    consumers = [FakeWebSocket(latencies, options.sampleEvery)
+                    for _ in xrange(options.consumers)]
+    clients   = [websocketModule.addConsumer(ws) for ws in consumers]
+
+    server = aggregator.Server(options.port, publisher)
+
+    publisher.start()
+    server.listen()
+
+    received  = registry.meter("ingest", "packets")
+    published = registry.meter("ingest", "published")
+
+    gevent.sleep(options.warmup)
+
+    del latencies[:]
+    startReceived, startPublished = received.total, published.total
+    startCommands = fakeRedis.commands
+    startCpu, _   = usage()
+    started       = time.time()
+
+    gevent.sleep(options.duration)
+
+    elapsed = time.time() - started
+    cpu, rss = usage()
+
+    os.waitpid(pid, 0)
+
+    results = header(options)
+    results.update({
+        "sessions"  : len(server.sessions),
+        "packets"   : (received.total - startReceived) / elapsed,
+        "published" : (published.total - startPublished) / elapsed,
+        "redis"     : (fakeRedis.commands - startCommands) / elapsed,
+        "latency"   : {
+            "samples": len(latencies),
+            "p50"    : percentile(latencies, 0.5),
+            "p99"    : percentile(latencies, 0.99),
+        },
+        "cpu"       : (cpu - startCpu) / elapsed * 100,
+        "rss"       : rss,
+        "websocket" : {
+            "sent"   : sum(client.sent for client in clients),
+            "dropped": sum(client.dropped for client in clients),
+        },
+    })
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "xStats aggregator benchmark")
+    parser.add_argument("--reporters", "-n", type = int, default = 100,
+                        help = "Simulated reporters")
+    parser.add_argument("--modules", "-m", type = int, default = 4,
+                        help = "Modules per reporter")
+    parser.add_argument("--keys", "-k", type = int, default = 8,
+                        help = "Keys per module")
+    parser.add_argument("--interval", "-i", type = float, default = 1,
+                        help = "Seconds between reports of a reporter")
+    parser.add_argument("--unbatched", action = "store_true",
+                        help = "Send a packet per module instead of batches")
+    parser.add_argument("--protocols", nargs = "+", default = ["json"],
+                        help = "Protocols the reporters offer")
+    parser.add_argument("--consumers", "-c", type = int, default = 10,
+                        help = "Simulated websocket consumers")
+    parser.add_argument("--sample-every", dest = "sampleEvery", type = int,
+                        default = 10,
+                        help = "Decode every Nth frame to measure latency")
+    parser.add_argument("--history", action = "store_true",
+                        help = "Enable redis history")
+    parser.add_argument("--port", "-p", type = int, default = 13399,
+                        help = "Port to run the aggregator on")
+    parser.add_argument("--warmup", type = float, default = 5,
+                        help = "Seconds before measuring")
+    parser.add_argument("--duration", "-d", type = float, default = 30,
+                        help = "Seconds to measure")
+    parser.add_argument("--output", "-o",
+                        help = "File to write the results to, as JSON")
+
+    options = parser.parse_args()
+
+    setup_logging("WARNING")
+
+    results = run(options)
+
+    print ujson.dumps(results)
+
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(ujson.dumps(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Micro-benchmarks of the reporter hot paths.
+
+    python -m xstats.bench.reporter --output results.json
+
+Every benchmark is timed with `timeit`, the best of `--repeat` runs is
+reported in microseconds per call.
+"""
+
+import argparse
+import time
+import timeit
+
+import ujson
+
+from xstats import net
+from xstats.bench.shared import header
+from xstats.daemon import reporter
+from xstats.daemon.network import Session
+from xstats.daemon.protocol import BinaryProtocol, JsonProtocol
+from xstats.daemon.shared import setup_logging
+
+class NullPublisher(object):
+    """Stand-in for `reporter.Publisher` that throws everything away"""
+
+    def publish(self, moduleName, data):
+        pass
+
+class NullClient(object):
+    """Stand-in for `network.Client` that only encodes packets"""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def send(self, packet):
+        self.protocol.encode(packet)
+
+class NullSocket(object):
+    """Socket that accepts and forgets everything"""
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+def sampleBenchmark(module, sampler):
+    """
+    Benchmark one `sample` call of `module`, fed the same snapshot every call
+    """
+
+    module.publisher = NullPublisher()
+
+    # Pretend a minute passes every call, so modules with an interval
+    # always report
+    clock = [time.time()]
+
+    # First sample only primes the module
+    module.sample(clock[0], sampler.snapshot())
+
+    snapshot = sampler.snapshot()
+
+    def sample():
+        clock[0] += 60
+        module.sample(clock[0], snapshot)
+
+    return sample
+
+def benchmarks():
+    """
+    Build the benchmarks
+
+    :returns: List of (name, callable)
+    """
+
+    sampler = reporter.Sampler()
+    sampler.active = tuple(sampler.sources)
+
+    stats  = net.RollingStats(('bytes_sent', 'bytes_recv'), 30)
+    packet = {
+        "module"   : "network",
+        "host"     : "bench",
+        "timestamp": int(time.time()),
+        "data"     : {"bytes-sent": 123456.5, "bytes-recv": 654321.25,
+                      "packets-sent": 1234.0, "packets-recv": 4321.0},
+    }
+
+    # What a reporter with the usual modules sends per interval
+    batch = [
+        {"module": "network", "data": packet["data"]},
+        {"module": "bandwidth", "data": {
+            "bytes-sent-avg": 1024.5, "bytes-recv-avg": 2048.25}},
+        {"module": "cpu", "data": {
+            "user": 12.5, "system": 3.25, "idle": 83.0, "iowait": 1.25,
+            "nice": 0.0, "irq": 0.0, "softirq": 0.0}},
+        {"module": "memory", "data": {
+            "total": 8589934592, "available": 4294967296,
+            "percent": 50.0, "used": 4294967296, "free": 2147483648}},
+        {"module": "reporter", "data": {
+            "cpu": 0.5, "rss": 20480, "network-cpu": 0.1,
+            "network-objects": 120}},
+    ]
+
+    attributes = ('bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv')
+
+    result = [
+        # `get_network_avg` without its sleep
+        ("net.get_network_avg",
+            lambda: net.calculate_rates(net.get_network_counters(),
+                                        net.get_network_counters(), 1,
+                                        attributes)),
+        ("rolling average tick",
+            lambda: (stats.update((1024.0, 2048.0)), stats.averages())),
+        ("Sampler.snapshot (all sources)", sampler.snapshot),
+    ]
+
+    modules = [
+        ("NetworkModule", reporter.NetworkModule()),
+        ("BandwidthRollingAvgModule",
+            reporter.BandwidthRollingAvgModule(extended = True)),
+        ("CpuModule", reporter.CpuModule()),
+        ("CpuModule percpu", reporter.CpuModule(percpu = True)),
+        ("MemoryModule", reporter.MemoryModule()),
+    ]
+
+    for name, module in modules:
+        result.append(("{}.sample".format(name),
+                       sampleBenchmark(module, sampler)))
+
+    for protocol in (JsonProtocol(), BinaryProtocol()):
+        client = NullClient(protocol)
+        result.append(("send_publish_batch ({})".format(protocol.name),
+            lambda client = client: reporter.send_publish_batch(
+                batch, client, {"host": "bench"})))
+
+        session = Session(NullSocket(), ("bench", 0))
+        session.protocol = protocol
+        result.append(("Session._sendPacket ({})".format(protocol.name),
+            lambda session = session: session._sendPacket(packet)))
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description = "xStats reporter benchmarks")
+    parser.add_argument("--number", "-n", type = int, default = 1000,
+                        help = "Calls per run")
+    parser.add_argument("--repeat", "-r", type = int, default = 3,
+                        help = "Runs per benchmark, the best one counts")
+    parser.add_argument("--output", "-o",
+                        help = "File to write the results to, as JSON")
+
+    options = parser.parse_args()
+
+    setup_logging("WARNING")
+
+    results = header(options)
+    results["benchmarks"] = {}
+
+    for name, function in benchmarks():
+        best = min(timeit.Timer(function).repeat(options.repeat,
+                                                 options.number))
+        perCall = best / options.number * 1e6
+
+        results["benchmarks"][name] = perCall
+        print "{:<40} {:>10.2f} us".format(name, perCall)
+
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(ujson.dumps(results))
+
+if __name__ == "__main__":
+    main()
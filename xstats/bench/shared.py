@@ -0,0 +1,21 @@
+import os
+import subprocess
+import time
+
+def commit():
+    """Git commit of the working directory, None if unknown"""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr = open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def header(options):
+    """Fields every result file starts with"""
+
+    return {
+        "commit"   : commit(),
+        "timestamp": int(time.time()),
+        "options"  : vars(options),
+    }
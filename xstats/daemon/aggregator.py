@@ -1,6 +1,11 @@
 from gevent import monkey; monkey.patch_socket()
 
+import fnmatch
 import functools
+import os
+import re
+import tempfile
+import time
 
 import ujson
 import gevent
@@ -9,135 +14,1524 @@ import sys
 
 import network
 
-from bottle import run, get, Bottle
+from collections import deque, OrderedDict
+
+from gevent.event import Event
+from gevent.socket import socketpair
+
+from bottle import run, get, request, abort, Bottle
 from bottle.ext.websocket import GeventWebSocketServer, websocket
 
-from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import ConnectionError as RedisConnectionError, \
+                             ResponseError
+
+from shared import parseConfig, loadModulesFromConfig, BasePublisher, \
+                   Backoff, CircuitBreaker
+from metrics import registry
+from spool import OutageSpool, SendSpool
+from state import LatestStore
+from segments import Partition, aggregate, between, column, merge
+from tsdb import Series, downsample
+
+from twiggy import log; logger = log.name(__name__)
+
+class Session(network.ServerSession):
+    # Time spent decoding packets, of all sessions
+    decodeTimer = registry.histogram("ingest", "decode")
+
+    # Packets received, of all sessions
+    received = registry.meter("ingest", "packets")
+
+    def __init__(self, server, socket, address, publisher):
+        # Stitch the publisher's `handle` method to this as the packet handler
+        self.packetHandler = publisher.handle
+
+        # Packets received by this session
+        self.metricName = "{}:{}".format(address[0], address[1])
+        self.meter      = registry.meter("sessions", self.metricName)
+
+        network.ServerSession.__init__(self, server, socket, address)
+
+    def _recvPacket(self, packet):
+        self.meter.mark()
+        self.received.mark()
+
+        network.ServerSession._recvPacket(self, packet)
+
+    def _compress(self, name):
+        network.ServerSession._compress(self, name)
+
+        # Bytes before and after compression
+        registry.gauge("sessions", "{}-bytes".format(self.metricName),
+                       self.byteCounts)
+
+class Server(network.Server):
+    def __init__(self, port, publisher, protocols = None, reusePort = False,
+                 acceptRate = None, maxHandshakes = None, retryAfter = 5,
+                 compression = None, handshakeTimeout = 30):
+        """
+        :publisher: Publisher to push data to
+
+        for more info see `xstats.daemon.network.Server`
+        """
+
+        # Use our custom `Session` object as session factory,
+        # pass in `publisher` as default argument
+        self.session = functools.partial(Session, publisher = publisher)
+
+        network.Server.__init__(self, port, protocols, reusePort,
+                                acceptRate, maxHandshakes, retryAfter,
+                                compression, handshakeTimeout)
+
+        registry.gauge("ingest", "sessions", lambda: len(self.sessions))
+        registry.gauge("ingest", "handshaking", lambda: self.handshaking)
+        registry.gauge("ingest", "rejected", lambda: self.rejected)
+
+    def handleDisconnect(self, session):
+        registry.remove("sessions", session.metricName)
+        registry.remove("sessions", "{}-bytes".format(session.metricName))
+
+        network.Server.handleDisconnect(self, session)
+
+class Module(object):
+    """
+    Base for publisher modules
+
+    Packets reach a module through its own bounded queue, drained by
+    `workers` greenlets that hand up to `batchSize` queued packets at a time
+    to `pushMany`. A slow module therefore doesn't hold up ingestion or the
+    other modules. When the queue is full `overflow` decides what happens:
+
+    block:       wait for room, pushing back on the reporter sessions
+    drop-oldest: drop the oldest queued packet
+    drop-newest: drop the new packet
+    """
+
+    overflowPolicies = ("block", "drop-oldest", "drop-newest")
+
+    # Whether the module has to run in a single process when running with
+    # several worker processes, e.g. because it listens on a port
+    shared = False
+
+    # Module class -> instances started, to tell their metrics apart
+    instances = {}
+
+    # Appended to the metric names, -<n> for the nth instance of a class
+    # after the first
+    instance = ""
+
+    def __init__(self, backlog = 10000, overflow = "drop-oldest", workers = 1,
+                 batchSize = 500):
+        """
+        :backlog:   Maximum number of queued packets
+        :overflow:  What to do when the queue is full, see `overflowPolicies`
+        :workers:   Number of worker greenlets
+        :batchSize: Maximum packets per `pushMany` call
+        """
+
+        if overflow not in self.overflowPolicies:
+            raise ValueError("Unknown overflow policy '{}'".format(overflow))
+
+        self.backlog   = backlog
+        self.overflow  = overflow
+        self.workers   = workers
+        self.batchSize = batchSize
+
+        self.queue    = deque()
+        self.notEmpty = Event()
+        self.notFull  = Event()
+        self.notFull.set()
+
+        self.dropped = 0
+
+    def enqueue(self, packets):
+        """
+        Queue packets for the workers
+
+        :packets: List of packets
+        """
+
+        for packet in packets:
+            if len(self.queue) >= self.backlog:
+                if self.overflow == "drop-newest":
+                    self.dropped += 1
+                    continue
+
+                if self.overflow == "drop-oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.queue) >= self.backlog:
+                        self.notFull.clear()
+                        self.notFull.wait()
+
+            self.queue.append(packet)
+
+        self.notEmpty.set()
+
+    def dequeue(self, maximum):
+        """
+        Get up to `maximum` queued packets, waiting until there is at least
+        one
+
+        :returns: List of packets
+        """
+
+        while not self.queue:
+            self.notEmpty.clear()
+            self.notEmpty.wait()
+
+        packets = [self.queue.popleft()
+                        for _ in xrange(min(maximum, len(self.queue)))]
+
+        self.notFull.set()
+
+        return packets
+
+    def _workLoop(self):
+        """Hand queued packets to `pushMany`"""
+
+        log = logger.name("worker").fields(module = self.__class__.__name__)
+
+        while True:
+            packets = self.dequeue(self.batchSize)
+
+            started = time.time()
+
+            try:
+                self.pushMany(packets)
+            except Exception as e:
+                log.trace('error').error("Failed to push {} packets: {}",
+                                         len(packets), e)
+
+            self.pushTimer.since(started)
+
+    def metricName(self):
+        """Name of the module in the metrics, its config name"""
+
+        return self.__class__.__name__.replace("Module", "") + self.instance
+
+    def metricGroup(self, group):
+        """Metrics group `group` of this instance"""
+
+        return group + self.instance
+
+    def startWorkers(self):
+        """Spawn the worker greenlets"""
+
+        count = Module.instances[type(self)] = \
+            Module.instances.get(type(self), 0) + 1
+
+        if count > 1:
+            self.instance = "-{}".format(count)
+
+        name = self.metricName()
+
+        self.pushTimer = registry.histogram("modules", "{}-push".format(name))
+
+        registry.gauge("modules", "{}-queued".format(name),
+                       lambda: len(self.queue))
+        registry.gauge("modules", "{}-dropped".format(name),
+                       lambda: self.dropped)
+
+        for _ in xrange(self.workers):
+            gevent.spawn(self._workLoop)
+
+    def push(self, data):
+        """
+        Called to push new data
+
+        :data: Contains the packet data
+        """
+        pass
+
+    def pushMany(self, packets):
+        """
+        Called to push a batch of packets, override to handle them in one go
+
+        :packets: List of packets
+        """
+
+        for packet in packets:
+            self.push(packet)
+
+    def start(self):
+        """
+        Method called when module gets initialized, use to start any
+        greenlets, listeners, etc.
+        """
+
+        pass
+
+class WebsocketClient(object):
+    """
+    A connected websocket client, with its own bounded outbound queue that
+    is drained by a sender greenlet so a slow client can't stall others.
+
+    What happens when the queue is full depends on `policy`:
+
+    drop-oldest: drop the oldest queued frame
+    coalesce:    replace a queued frame of the same host/module, drop the
+                 oldest if there is none
+    disconnect:  disconnect the client
+
+    A client can also ask for a maximum update rate, updates are then merged
+    per host/module/key and sent as one {"batch": [packet, ...]} frame per
+    period.
+    """
+
+    policies = ("drop-oldest", "coalesce", "disconnect")
+
+    # Shortest period a client can ask for, in seconds
+    minInterval = 0.05
+
+    def __init__(self, ws, address, queueSize = 100, policy = "drop-oldest"):
+        """
+        :ws:        Websocket to send on
+        :address:   Remote address, for logging/stats
+        :queueSize: Maximum number of queued frames
+        :policy:    What to do when the queue is full, see `policies`
+        """
+
+        if policy not in self.policies:
+            raise ValueError("Unknown slow consumer policy '{}'".format(policy))
+
+        self.ws        = ws
+        self.address   = address
+        self.queueSize = queueSize
+        self.policy    = policy
+
+        # Key -> frame, keyed on host/module when coalescing or a sequence
+        # number otherwise
+        self.queue    = OrderedDict()
+        self.sequence = 0
+        self.ready    = Event()
+        self.closed   = False
+
+        # Compiled (host, module) patterns, None means everything
+        self.subscriptions = None
+
+        # Seconds between merged frames, None sends every packet right away
+        self.interval      = None
+        self.merged        = OrderedDict()
+        self.mergeGreenlet = None
+
+        self.sent      = 0
+        self.dropped   = 0
+        self.coalesced = 0
+
+        self.log = logger.name("websocket-client").fields(address = address)
+
+        self.greenlet = gevent.spawn(self._sendLoop)
+
+    def subscribe(self, patterns):
+        """
+        Replace the subscriptions of this client
+
+        :patterns: List of {"host": ..., "module": ...} dictionaries with
+                   fnmatch style patterns, a missing field matches anything
+        """
+
+        self.subscriptions = [
+            (re.compile(fnmatch.translate(pattern.get("host", "*"))),
+             re.compile(fnmatch.translate(pattern.get("module", "*"))))
+                for pattern in patterns
+        ]
+
+    def matches(self, host, module):
+        """Whether this client wants packets of `host`/`module`"""
+
+        if self.subscriptions is None:
+            return True
+
+        for hostPattern, modulePattern in self.subscriptions:
+            if hostPattern.match(host or "") and \
+               modulePattern.match(module or ""):
+                return True
+
+        return False
+
+    def limit(self, interval):
+        """
+        Limit the rate of updates to one frame per `interval`
+
+        :interval: Seconds between frames, None to send every packet
+        """
+
+        if self.mergeGreenlet is not None:
+            self.mergeGreenlet.kill(block = False)
+            self.mergeGreenlet = None
+
+        self.flushMerged()
+
+        if interval is None:
+            self.interval = None
+            return
+
+        self.interval      = max(self.minInterval, interval)
+        self.mergeGreenlet = gevent.spawn(self._mergeLoop)
+
+    def merge(self, key, packet):
+        """
+        Merge a packet into the pending update of its host/module, for
+        rate limited clients
+
+        :key:    (host, module) of the packet
+        :packet: Packet to merge
+        """
+
+        if self.closed:
+            return
+
+        pending = self.merged.get(key)
+
+        if pending is None:
+            self.merged[key] = {
+                "host"     : packet.get("host"),
+                "module"   : packet.get("module"),
+                "timestamp": packet.get("timestamp"),
+                "data"     : dict(packet["data"]),
+            }
+        else:
+            pending["timestamp"] = packet.get("timestamp")
+            pending["data"].update(packet["data"])
+            self.coalesced += 1
+
+    def flushMerged(self):
+        """Queue the merged updates as a single frame"""
+
+        if not self.merged:
+            return
+
+        packets, self.merged = self.merged.values(), OrderedDict()
+
+        # A batch only holds what changed in its interval, so it must never
+        # replace an unsent one when coalescing
+        key = ("batch", self.sequence)
+        self.sequence += 1
+
+        self.enqueue(key, ujson.dumps({"batch": packets}))
+
+    def _mergeLoop(self):
+        """Queue the merged updates every `interval`"""
+
+        while not self.closed:
+            gevent.sleep(self.interval)
+            self.flushMerged()
+
+    def enqueue(self, key, frame):
+        """
+        Queue an encoded frame, never blocks
+
+        :key:   (host, module) the frame is for
+        :frame: Encoded frame
+        """
+
+        if self.closed:
+            return
+
+        if self.policy == "coalesce":
+            if key in self.queue:
+                self.queue[key] = frame
+                self.coalesced += 1
+                return
+        else:
+            key = self.sequence
+            self.sequence += 1
+
+        if len(self.queue) >= self.queueSize:
+            self.dropped += 1
+
+            if self.policy == "disconnect":
+                self.log.warning("Queue full, disconnecting slow client")
+                self.close()
+                return
+
+            self.queue.popitem(last = False)
+
+        self.queue[key] = frame
+        self.ready.set()
+
+    def _sendLoop(self):
+        """Send queued frames until the client is closed"""
+
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+
+            while self.queue and not self.closed:
+                _, frame = self.queue.popitem(last = False)
+
+                try:
+                    self.ws.send(frame)
+                except Exception as e:
+                    self.log.debug("Send failed: {}", e)
+                    self.close()
+                    break
+
+                self.sent += 1
+
+    def close(self):
+        """Stop sending and close the websocket"""
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.clear()
+        self.merged.clear()
+        self.ready.set()
+
+        if self.mergeGreenlet is not None:
+            self.mergeGreenlet.kill(block = False)
+
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            "address"   : self.address,
+            "queued"    : len(self.queue),
+            "sent"      : self.sent,
+            "dropped"   : self.dropped,
+            "coalesced" : self.coalesced,
+            "subscribed": self.subscriptions is not None,
+            "interval"  : self.interval,
+            "merged"    : len(self.merged),
+        }
+
+class WebsocketModule(Module):
+    """
+    Serves packets to websocket clients at /stats, runs in the designated
+    process when running with worker processes.
+
+    Clients get everything unless they send a subscription:
+
+        {"subscribe": [{"host": "web*", "module": "cpu"}, ...]}
+
+    An index from (host, module) to subscribed clients is kept, so packets
+    nobody wants are never encoded.
+
+    After subscribing a client gets the latest state of everything it
+    subscribed to as a single frame, followed by live updates:
+
+        {"snapshot": [packet, ...]}
+
+    Clients can limit the rate of updates, in frames per second or seconds
+    between frames (null to remove the limit):
+
+        {"rate": 4} or {"interval": 5}
+    """
+
+    shared = True
+
+    def __init__(self, host = '127.0.0.1', port = 8080, queueSize = 100,
+                 slowConsumer = "drop-oldest", **kwargs):
+        """
+        Initialize websocket module
+
+        :host: Host(IP) to listen on
+        :port: Port to listen on
+        :queueSize:    Maximum frames queued per client
+        :slowConsumer: What to do when a client's queue is full, one of
+                       `WebsocketClient.policies`
+
+        For the other options see `Module.__init__`
+        """
+
+        Module.__init__(self, **kwargs)
+
+        self.host = host
+        self.port = port
+
+        # Set by the `Publisher`
+        self.publisher = None
+
+        self.queueSize    = queueSize
+        self.slowConsumer = slowConsumer
+
+        self.clients = set()
+        self.app     = Bottle()
+
+        # (host, module) -> clients that want it, built lazily and cleared
+        # whenever clients or subscriptions change
+        self.index = {}
+
+        self.log = logger.name("websocket") \
+                         .fields(host = host, port = port)
+
+        @self.app.get('/stats', apply=[websocket])
+        def stats(ws):
+            # Add the client
+            client = WebsocketClient(ws, request.remote_addr,
+                                     self.queueSize, self.slowConsumer)
+            self.clients.add(client)
+            self.index.clear()
+
+            # Start socket loop
+            try:
+                while True:
+                    msg = ws.receive()
+                    if msg is None:
+                        break
+
+                    self.handleMessage(client, msg)
+            finally:
+                # Connection closed, remove client
+                self.clients.discard(client)
+                self.index.clear()
+                client.close()
+
+        @self.app.get('/clients')
+        def clients():
+            return {"clients": [client.stats() for client in self.clients]}
+
+    def handleMessage(self, client, msg):
+        """
+        Handle a message sent by a client
+
+        :client: `WebsocketClient` that sent it
+        :msg:    Message received
+        """
+
+        try:
+            message = ujson.loads(msg)
+
+            if "rate" in message:
+                rate = message["rate"]
+                client.limit(1.0 / rate if rate else None)
+
+            if "interval" in message:
+                interval = message["interval"]
+                client.limit(float(interval) if interval else None)
+
+            if "subscribe" in message:
+                client.subscribe(message["subscribe"])
+            else:
+                return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.log.debug("Ignoring invalid message {!r}: {}", msg, e)
+            return
+
+        self.index.clear()
+
+        self.sendSnapshot(client)
+
+    def sendSnapshot(self, client):
+        """
+        Queue the latest state of everything `client` is subscribed to
+
+        :client: `WebsocketClient` to send to
+        """
+
+        packets = self.publisher.store.snapshot(client.matches)
+        if not packets:
+            return
+
+        client.enqueue("snapshot", ujson.dumps({"snapshot": packets}))
+
+    def backlog(self):
+        """Frames queued for the clients, in total and for the worst one"""
+
+        queued = [len(client.queue) for client in self.clients]
+
+        return {"total": sum(queued), "max": max(queued) if queued else 0}
+
+    def start(self):
+        """Spawn the bottle webserver in a greenlet"""
+
+        group = self.metricGroup("websocket")
+
+        registry.gauge(group, "clients", lambda: len(self.clients))
+        registry.gauge(group, "backlog", self.backlog)
+        registry.gauge(group, "dropped", lambda: sum(
+            client.dropped for client in self.clients
+        ))
+
+        gevent.spawn(self._start)
+
+    def _start(self):
+        """Run the websocket bottle app"""
+
+        run(self.app, host = self.host,
+                      port = self.port,
+                      server = GeventWebSocketServer)
+        self.log.debug("Started server at {}:{}", self.host, self.port)
+
+
+    def subscribers(self, key):
+        """
+        Get the clients that want packets for `key`
+
+        :key: (host, module)
+        :returns: Tuple of clients
+        """
+
+        clients = self.index.get(key)
+
+        if clients is None:
+            clients = self.index[key] = tuple(
+                client for client in self.clients if client.matches(*key)
+            )
+
+        return clients
+
+    def push(self, packet):
+        """
+        Queue data for all websocket clients interested in it, the packet is
+        only encoded once and not at all if nobody is interested
+        """
+
+        key     = (packet.get("host"), packet.get("module"))
+        clients = self.subscribers(key)
+
+        if not clients:
+            return
+
+        self.log.debug("Pushing {}", packet)
+
+        frame = None
+
+        for client in clients:
+            if client.interval is not None:
+                client.merge(key, packet)
+                continue
+
+            # Encoded once, and only if a client wants it right away
+            if frame is None:
+                frame = ujson.dumps(packet)
+
+            client.enqueue(key, frame)
+
+class ForwardModule(Module):
+    """
+    Relays packets to an upstream aggregator, so aggregators can be
+    arranged in a tree. Runs in the designated process when running with
+    worker processes, so there's a single upstream connection.
+
+    Packets are forwarded with their full data (no deltas), a batch per
+    host. With `aggregate` set, a summary of the latest data of every host
+    is sent every `aggregateInterval` seconds, as host `aggregate` with the
+    same modules and for every numeric key <key>-sum, -avg, -min and -max
+    plus the number of hosts. Set `raw` to false to only send summaries.
+    """
+
+    shared = True
+
+    def __init__(self, host = '127.0.0.1', port = 13337, protocols = None,
+                 raw = True, aggregate = None, aggregateInterval = 10,
+                 staleAfter = None, spoolMemory = 10000, **kwargs):
+        """
+        :host: Host of the upstream aggregator
+        :port: Port of the upstream aggregator
+        :protocols: Protocols to offer upstream, in order of preference
+        :raw:       Forward every packet
+        :aggregate: Host name to send per module summaries as, None for no
+                    summaries
+        :aggregateInterval: Seconds between summaries
+        :staleAfter:  Seconds after which a host that stopped reporting is
+                      left out of the summaries, 3 intervals by default
+        :spoolMemory: Packets to hold while the upstream is unreachable
+
+        For the other options see `Module.__init__`
+        """
+
+        Module.__init__(self, **kwargs)
+
+        self.raw               = raw
+        self.aggregate         = aggregate
+        self.aggregateInterval = aggregateInterval
+        self.staleAfter        = staleAfter or 3 * aggregateInterval
+
+        self.client = network.Client((host, port), protocols,
+                                     SendSpool(spoolMemory))
+
+        # (host, module) -> (time received, timestamp, data)
+        self.latest = {}
+
+        self.log = logger.name("forward") \
+                         .fields(host = host, port = port)
+
+    def start(self):
+        """Connect upstream and start summarizing"""
+
+        group = self.metricGroup("forward")
+
+        registry.gauge(group, "queued", lambda: len(self.client.sendQueue))
+        registry.gauge(group, "dropped",
+                       lambda: self.client.sendQueue.dropped)
+
+        gevent.spawn(self.client.connect)
+
+        if self.aggregate:
+            gevent.spawn(self._aggregateLoop)
+
+    def pushMany(self, packets):
+        if self.aggregate:
+            now = time.time()
+
+            for packet in packets:
+                self.latest[(packet.get("host"), packet["module"])] = \
+                    (now, packet.get("timestamp"), packet["data"])
+
+        if not self.raw:
+            return
+
+        # Batch entries only carry a module and data in every protocol,
+        # so a batch per host/timestamp
+        batches = OrderedDict()
+
+        for packet in packets:
+            key = (packet.get("host"), packet.get("timestamp"))
+            batches.setdefault(key, []).append(
+                {"module": packet["module"], "data": packet["data"]}
+            )
+
+        for (host, timestamp), entries in batches.iteritems():
+            self.client.send({"host": host, "timestamp": timestamp,
+                              "batch": entries})
+
+    def summarize(self):
+        """
+        Summarize the latest data of the hosts that are still reporting
+
+        :returns: Batch packet, None if there's nothing to summarize
+        """
+
+        cutoff = time.time() - self.staleAfter
+
+        # Module -> key -> [sum, min, max, count], and hosts per module
+        modules   = {}
+        hosts     = {}
+        timestamp = 0
+
+        for key, (received, packetTimestamp, data) in self.latest.items():
+            if received < cutoff:
+                del self.latest[key]
+                continue
+
+            module = key[1]
+            values = modules.setdefault(module, {})
+            hosts[module] = hosts.get(module, 0) + 1
+
+            timestamp = max(timestamp, packetTimestamp)
+
+            for name, value in data.iteritems():
+                if isinstance(value, bool) or \
+                   not isinstance(value, (int, long, float)):
+                    continue
+
+                summary = values.get(name)
+                if summary is None:
+                    values[name] = [value, value, value, 1]
+                else:
+                    summary[0] += value
+                    summary[1]  = min(summary[1], value)
+                    summary[2]  = max(summary[2], value)
+                    summary[3] += 1
+
+        if not modules:
+            return None
+
+        batch = []
+        for module, values in modules.iteritems():
+            data = {"hosts": hosts[module]}
+
+            for name, (total, minimum, maximum, count) in values.iteritems():
+                data["{}-sum".format(name)] = total
+                data["{}-avg".format(name)] = total / float(count)
+                data["{}-min".format(name)] = minimum
+                data["{}-max".format(name)] = maximum
+
+            batch.append({"module": module, "data": data})
+
+        return {"host": self.aggregate, "timestamp": timestamp,
+                "batch": batch}
+
+    def _aggregateLoop(self):
+        """Send a summary every `aggregateInterval`"""
+
+        while True:
+            gevent.sleep(self.aggregateInterval)
+
+            packet = self.summarize()
+            if packet is not None:
+                self.client.send(packet)
+
+def parseQueryTime(value):
+    """Parse a query start/end, negative is seconds before now"""
+
+    if not value:
+        return None
+
+    value = int(value)
+    return int(time.time()) + value if value < 0 else value
+
+class StoreModule(Module):
+    """
+    Keeps the recent history of every numeric key in memory, compressed
+    (see `tsdb`), and serves it over HTTP without going through redis. Runs
+    in the designated process when running with worker processes.
+
+        /series?host=web*&module=cpu
+            {"series": [[host, module, key], ...]}, host and module are
+            fnmatch style patterns
+
+        /query?host=web1&module=cpu&key=user&start=-3600&step=60&aggregate=max
+            {"host": ..., "module": ..., "key": ..., "points": [[t, v], ...]}
+            start and end are unix timestamps, or seconds before now when
+            negative. With step the points are aggregated per step seconds
+            with avg (default), min, max, sum, count or last.
+
+    Points that aren't newer than the last one of their key are dropped,
+    counted in store/out-of-order.
+    """
+
+    shared = True
+
+    def __init__(self, host = '127.0.0.1', port = 8081, chunkSize = 1024,
+                 retention = 10800, **kwargs):
+        """
+        :host: Host(IP) to listen on
+        :port: Port to listen on
+        :chunkSize: Points per compressed chunk, whole chunks are expired
+        :retention: Seconds of history to keep
+
+        For the other options see `Module.__init__`
+        """
+
+        Module.__init__(self, **kwargs)
+
+        self.host      = host
+        self.port      = port
+        self.chunkSize = chunkSize
+        self.retention = retention
+
+        # (host, module, key) -> Series
+        self.series = {}
+
+        # Points dropped for not being newer than the last of their key,
+        # apart from `dropped` which counts queue overflows
+        self.outOfOrder = 0
+
+        self.app = Bottle()
+
+        self.log = logger.name("store") \
+                         .fields(host = host, port = port)
+
+        @self.app.get('/series')
+        def series():
+            host   = re.compile(fnmatch.translate(request.query.host or "*"))
+            module = re.compile(fnmatch.translate(request.query.module or "*"))
+
+            return {"series": sorted(
+                list(key) for key in self.series
+                    if host.match(key[0]) and module.match(key[1])
+            )}
+
+        @self.app.get('/query')
+        def query():
+            query = request.query
+            key   = (query.host, query.module, query.key)
+
+            series = self.series.get(key)
+            if series is None:
+                abort(404, "Unknown series")
+
+            try:
+                start = parseQueryTime(query.start)
+                end   = parseQueryTime(query.end)
+                step  = int(query.step) if query.step else None
+                if step is not None and step <= 0:
+                    raise ValueError("step must be positive")
+
+                points = series.points(start, end)
+
+                if step:
+                    points = downsample(points, step,
+                                        query.aggregate or "avg")
+                else:
+                    points = list(points)
+            except (ValueError, KeyError) as e:
+                abort(400, "Invalid query: {}".format(e))
+
+            return {"host": key[0], "module": key[1], "key": key[2],
+                    "points": points}
+
+    def start(self):
+        """Start the HTTP server and expiry"""
+
+        group = self.metricGroup("store")
+
+        registry.gauge(group, "series", lambda: len(self.series))
+        registry.gauge(group, "bytes", lambda: sum(
+            series.size() for series in self.series.itervalues()
+        ))
+        registry.gauge(group, "out-of-order", lambda: self.outOfOrder)
+
+        gevent.spawn(run, self.app, host = self.host, port = self.port,
+                     server = "gevent", quiet = True)
+        gevent.spawn(self._expireLoop)
+
+    def push(self, packet):
+        host      = packet.get("host") or ""
+        module    = packet["module"]
+        timestamp = int(packet.get("timestamp") or time.time())
+
+        for name, value in packet["data"].iteritems():
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, long, float)):
+                continue
+
+            key    = (host, module, name)
+            series = self.series.get(key)
+
+            if series is None:
+                series = self.series[key] = Series(self.chunkSize)
+
+            if not series.append(timestamp, float(value)):
+                self.outOfOrder += 1
+
+    def _expireLoop(self):
+        """Drop expired chunks, and series that stopped reporting"""
+
+        while True:
+            gevent.sleep(60)
+
+            before = time.time() - self.retention
+
+            for key, series in self.series.items():
+                if series.last() < before:
+                    del self.series[key]
+                else:
+                    series.expire(before)
+
+class StorageModule(Module):
+    """
+    Stores packets on disk, for sites without redis. Every numeric key is a
+    column in time partitioned segment files, see `segments`. Runs in the
+    designated process when running with worker processes.
+
+    Packets are buffered and written as a new segment of their partition
+    every `flushInterval` seconds, segments are never appended to. Segment
+    files are written, merged and removed in a thread. In the
+    background the segments of finished partitions (or of any partition
+    with more than `maxSegments`) are compacted into one, and partitions
+    older than `retention` are removed, so writes cost the same however
+    much is stored.
+
+    The same /series and /query endpoints as `StoreModule` are served,
+    reading the segments through mmap and aggregating with NumPy when it's
+    installed.
+    """
+
+    shared = True
+
+    def __init__(self, path = "xstats-storage", host = '127.0.0.1',
+                 port = 8082, partition = 3600, retention = 604800,
+                 flushInterval = 10, flushSize = 100000,
+                 compactInterval = 60, maxSegments = 16, **kwargs):
+        """
+        :path: Directory to store the partitions in
+        :host: Host(IP) to listen on
+        :port: Port to listen on
+        :partition: Seconds per partition
+        :retention: Seconds of history to keep
+        :flushInterval: Max seconds between segment writes
+        :flushSize:     Buffered points to write a segment at
+        :compactInterval: Seconds between compaction/expiry runs
+        :maxSegments:     Segments a partition can have before it's compacted
+                          while still being written to
+
+        For the other options see `Module.__init__`
+        """
+
+        Module.__init__(self, **kwargs)
+
+        self.path            = path
+        self.host            = host
+        self.port            = port
+        self.partitionSize   = partition
+        self.retention       = retention
+        self.flushInterval   = flushInterval
+        self.flushSize       = flushSize
+        self.compactInterval = compactInterval
+        self.maxSegments     = maxSegments
+
+        # Partition start -> Partition, oldest first
+        self.partitions = OrderedDict()
+
+        # Partition start -> (host, module, key) -> ([timestamp], [value]),
+        # `writing` is the buffer being flushed, still readable meanwhile
+        self.buffer   = {}
+        self.writing  = {}
+        self.buffered = 0
+        self.flushed  = Event()
+
+        self.app = Bottle()
+
+        self.log = logger.name("storage") \
+                         .fields(path = path)
+
+        @self.app.get('/series')
+        def series():
+            host   = re.compile(fnmatch.translate(request.query.host or "*"))
+            module = re.compile(fnmatch.translate(request.query.module or "*"))
+
+            return {"series": sorted(
+                list(key) for key in self.keys()
+                    if host.match(key[0]) and module.match(key[1])
+            )}
+
+        @self.app.get('/query')
+        def query():
+            query = request.query
+            key   = (query.host, query.module, query.key)
+
+            if not self.known(key):
+                abort(404, "Unknown series")
+
+            try:
+                start = parseQueryTime(query.start)
+                end   = parseQueryTime(query.end)
+                step  = int(query.step) if query.step else None
+                if step is not None and step <= 0:
+                    raise ValueError("step must be positive")
+
+                timestamps, values = self.read(key, start, end)
+
+                if step:
+                    points = aggregate(timestamps, values, step,
+                                       query.aggregate or "avg")
+                else:
+                    points = zip(timestamps.tolist(), values.tolist())
+            except (ValueError, KeyError) as e:
+                abort(400, "Invalid query: {}".format(e))
+
+            return {"host": key[0], "module": key[1], "key": key[2],
+                    "points": points}
+
+    def start(self):
+        """Load the partitions, start the HTTP server and background work"""
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        for start in sorted(int(name) for name in os.listdir(self.path)
+                                          if name.isdigit()):
+            self.partition(start)
+
+        self.log.info("Loaded {} partitions", len(self.partitions))
+
+        group = self.metricGroup("storage")
+
+        registry.gauge(group, "partitions", lambda: len(self.partitions))
+        registry.gauge(group, "segments", lambda: sum(
+            len(partition.segments)
+                for partition in self.partitions.itervalues()
+        ))
+        registry.gauge(group, "buffered", lambda: self.buffered)
+
+        gevent.spawn(run, self.app, host = self.host, port = self.port,
+                     server = "gevent", quiet = True)
+        gevent.spawn(self._flushLoop)
+        gevent.spawn(self._compactLoop)
+
+    def partition(self, start):
+        """Get the partition starting at `start`, creating it if needed"""
+
+        partition = self.partitions.get(start)
+
+        if partition is None:
+            partition = Partition(os.path.join(self.path, str(start)), start,
+                                  self.partitionSize)
+            self.partitions[start] = partition
+
+            # Keep them ordered when an older partition gets late data
+            if any(other > start for other in self.partitions):
+                self.partitions = OrderedDict(sorted(self.partitions.items()))
+
+        return partition
+
+    def push(self, packet):
+        host      = packet.get("host") or ""
+        module    = packet["module"]
+        timestamp = int(packet.get("timestamp") or time.time())
+
+        if timestamp < time.time() - self.retention:
+            return
+
+        columns = self.buffer.setdefault(
+            timestamp - timestamp % self.partitionSize, {}
+        )
+
+        for name, value in packet["data"].iteritems():
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, long, float)):
+                continue
+
+            pair = columns.get((host, module, name))
+            if pair is None:
+                pair = columns[(host, module, name)] = ([], [])
+
+            pair[0].append(timestamp)
+            pair[1].append(float(value))
+
+            self.buffered += 1
+
+        if self.buffered >= self.flushSize:
+            self.flushed.set()
+
+    def flush(self):
+        """
+        Write the buffered points, a segment per partition. The segments are
+        written in a thread, points of a partition whose segment couldn't be
+        written go back into the buffer.
+        """
+
+        self.writing  = buffer = self.buffer
+        self.buffer   = {}
+        self.buffered = 0
+
+        try:
+            for start, columns in sorted(buffer.items()):
+                try:
+                    self.partition(start).write(
+                        (key,) + column(*columns[key])
+                            for key in sorted(columns)
+                    )
+                except EnvironmentError as e:
+                    self.log.error("Writing a segment of partition {} failed, "
+                                   "keeping its points: {}", start, e)
+                    self.restore(start, columns)
+
+                # Readable from the partition or the buffer now
+                del buffer[start]
+        finally:
+            self.writing = {}
+
+    def restore(self, start, columns):
+        """Put the points of a failed write back into the buffer"""
+
+        buffered = self.buffer.setdefault(start, {})
+
+        for key, (timestamps, values) in columns.iteritems():
+            pair = buffered.get(key)
+
+            if pair is None:
+                buffered[key] = (timestamps, values)
+            else:
+                pair[0][:0] = timestamps
+                pair[1][:0] = values
+
+            self.buffered += len(timestamps)
 
-from shared import parseConfig, loadModulesFromConfig, BasePublisher
+    def _flushLoop(self):
+        while True:
+            self.flushed.wait(self.flushInterval)
+            self.flushed.clear()
 
-from twiggy import log; logger = log.name(__name__)
+            try:
+                self.flush()
+            except Exception as e:
+                self.log.trace('error').error("Flush failed: {}", e)
 
-class Session(network.ServerSession):
-    def __init__(self, server, socket, address, publisher):
-        # Stitch the publisher's `parse` method to this as the packet handler
-        self.packetHandler = publisher.parse
+    def buffers(self):
+        """Buffered columns by partition, including those being written"""
 
-        network.ServerSession.__init__(self, server, socket, address)
+        return self.buffer.values() + self.writing.values()
 
+    def keys(self):
+        """Keys of every stored and buffered column"""
 
-class Server(network.Server):
-    def __init__(self, port, publisher):
+        keys = set()
+
+        for partition in self.partitions.itervalues():
+            keys.update(partition.keys())
+        for columns in self.buffers():
+            keys.update(columns)
+
+        return keys
+
+    def known(self, key):
+        """Whether anything was ever stored for `key`"""
+
+        return any(key in columns for columns in self.buffers()) or \
+               any(key in segment.columns
+                       for partition in self.partitions.itervalues()
+                           for segment in partition.segments)
+
+    def read(self, key, start = None, end = None):
         """
-        :publisher: Publisher to push data to
+        Get the points of `key` between `start` and `end`, inclusive
 
-        for more info see `xstats.daemon.network.Server`
+        :returns: (timestamps, values) arrays
         """
 
-        # Use our custom `Session` object as session factory,
-        # pass in `publisher` as default argument
-        self.session = functools.partial(Session, publisher = publisher)
+        columns = []
 
-        network.Server.__init__(self, port)
+        for partitionStart, partition in self.partitions.items():
+            if (end is not None and partitionStart > end) or \
+               (start is not None and partition.end < start):
+                continue
 
-class Module(object):
-    """Base for publisher modules"""
+            columns.extend(partition.read(key, start, end))
 
-    def push(self, data):
+        for columnsByKey in self.buffers():
+            pair = columnsByKey.get(key)
+            if pair is not None:
+                columns.append(between(*column(*pair), start = start,
+                                       end = end))
+
+        return merge(columns)
+
+    def _compactLoop(self):
+        """Compact partitions and remove expired ones"""
+
+        while True:
+            gevent.sleep(self.compactInterval)
+
+            now = time.time()
+
+            for start, partition in self.partitions.items():
+                try:
+                    if partition.end < now - self.retention:
+                        self.log.info("Removing partition {}", start)
+
+                        del self.partitions[start]
+                        partition.remove()
+                    elif len(partition.segments) > self.maxSegments or \
+                         (partition.end + 2 * self.flushInterval < now and
+                          len(partition.segments) > 1):
+                        merged = partition.compact()
+                        self.log.debug("Compacted {} segments of partition {}",
+                                       merged, start)
+                except EnvironmentError as e:
+                    self.log.error("Compacting partition {} failed: {}",
+                                   start, e)
+
+class ChannelModule(Module):
+    """
+    Forwards the packets of a worker process to the designated process that
+    runs the shared modules, see `startWorkers`.
+    """
+
+    def __init__(self, session, **kwargs):
         """
-        Called to push new data
+        :session: `network.Session` connected to the designated process
 
-        :data: Contains the packet data
+        For the other options see `Module.__init__`
         """
-        pass
 
-    def start(self):
+        Module.__init__(self, **kwargs)
+
+        self.session = session
+
+    def pushMany(self, packets):
+        self.session.send({"batch": packets})
+
+class History(object):
+    """
+    Builds the redis commands for time-series history of every numeric
+    metric:
+
+    history:<host>-<module>:<key>:raw  list of "timestamp:value"
+    history:<host>-<module>:<key>:1m   list of "start:min:max:avg:count"
+    history:<host>-<module>:<key>:1h   list of "start:min:max:avg:count"
+
+    Every list is capped to its retention (in points). Rollups are built
+    incrementally, a bucket is written once a sample for a later bucket
+    arrives and is then folded into the next tier.
+    """
+
+    # (name, seconds per point), every tier is built from the one before
+    tiers = (("1m", 60), ("1h", 3600))
+
+    # Points to keep per tier
+    retention = {"raw": 3600, "1m": 1440, "1h": 720}
+
+    def __init__(self, retention = None):
         """
-        Method called when module gets initialized, use to start any
-        greenlets, listeners, etc.
+        :retention: Tier name -> points to keep, merged with the defaults
         """
 
-        pass
+        self.retention = dict(self.retention, **(retention or {}))
 
-class WebsocketModule(Module):
-    def __init__(self, host = '127.0.0.1', port = 8080):
-        """
-        Initialize websocket module
+        # (metric, tier) -> [start, min, max, total, count] of the open bucket
+        self.buckets = {}
 
-        :host: Host(IP) to listen on
-        :port: Port to listen on
+    def append(self, listName, tier, value, commands):
+        commands.append(["rpush", listName, value])
+        commands.append(["ltrim", listName, -self.retention[tier], -1])
+
+    def rollup(self, metric, tier, start, minimum, maximum, total, count,
+               commands):
+        """
+        Fold an aggregate starting at `start` into the bucket of `tier`,
+        closing the open bucket if the aggregate belongs to a later one
         """
 
-        self.host = host
-        self.port = port
+        if tier >= len(self.tiers):
+            return
 
-        self.clients = set()
-        self.app     = Bottle()
+        name, width = self.tiers[tier]
+        start       = start - start % width
 
-        self.log = logger.name("websocket") \
-                         .fields(host = host, port = port)
+        bucket = self.buckets.get((metric, name))
 
-        @self.app.get('/stats', apply=[websocket])
-        def stats(ws):
-            # Add the client
-            self.clients.add(ws)
+        if bucket is not None and start > bucket[0]:
+            self.append("{}:{}".format(metric, name), name,
+                        "{}:{}:{}:{}:{}".format(bucket[0], bucket[1],
+                            bucket[2], bucket[3] / float(bucket[4]),
+                            bucket[4]), commands)
+            self.rollup(metric, tier + 1, *(bucket + [commands]))
 
-            # Start socket loop
-            while True:
-                msg = ws.receive()
-                if msg is None:
-                    break
+            bucket = None
 
-            # Connection closed, remove client
-            self.clients.remove(ws)
+        if bucket is None:
+            self.buckets[(metric, name)] = [start, minimum, maximum, total,
+                                            count]
+        else:
+            # Late samples are folded into the open bucket
+            bucket[1]  = min(bucket[1], minimum)
+            bucket[2]  = max(bucket[2], maximum)
+            bucket[3] += total
+            bucket[4] += count
 
-    def start(self):
-        """Spawn the bottle webserver in a greenlet"""
-        gevent.spawn(self._start)
+    def commands(self, keyName, timestamp, data):
+        """
+        Get the commands recording the numeric values in `data`
 
-    def _start(self):
-        """Run the websocket bottle app"""
+        :keyName:   Name of the host/module hash
+        :timestamp: Unix timestamp of the packet
+        :data:      Packet data
+        :returns: List of [command, arg1, arg2, ...] lists
+        """
 
-        run(self.app, host = self.host,
-                      port = self.port,
-                      server = GeventWebSocketServer)
-        self.log.debug("Started server at {}:{}", self.host, self.port)
+        commands = []
 
+        for key, value in data.iteritems():
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, long, float)):
+                continue
 
-    def push(self, packet):
-        """Push data to all websocket clients that are connected"""
+            metric = "history:{}:{}".format(keyName, key)
 
-        self.log.debug("Pushing {}", packet)
+            self.append("{}:raw".format(metric), "raw",
+                        "{}:{}".format(timestamp, value), commands)
+            self.rollup(metric, 0, timestamp, value, value, value, 1,
+                        commands)
 
-        for client in self.clients:
-            client.send(ujson.dumps(packet))
+        return commands
 
 class RedisModule(Module):
-    def __init__(self, host='127.0.0.1', port = 6379, db = 0):
+    """
+    Stores the latest data of every host/module in a redis hash.
+
+    Writes are buffered and coalesced per hash (last write wins per field),
+    then flushed in a single pipeline every `flushInterval` seconds or once
+    `flushSize` writes are pending.
+
+    With `history` enabled every numeric value is also recorded in capped
+    lists with 1m/1h rollups, see `History`.
+
+    When redis is down a circuit breaker stops trying to reach it until a
+    backoff delay has passed, and all writes go to an `OutageSpool` which is
+    replayed in pipelined batches once redis is back.
+    """
+
+    def __init__(self, host='127.0.0.1', port = 6379, db = 0,
+                 flushInterval = 1.0, flushSize = 1000, spoolPath = None,
+                 spoolMemory = 16 * 1024 * 1024,
+                 spoolFile = 1024 * 1024 * 1024, replayBatch = 500,
+                 retryMax = 60, history = False, historyRetention = None,
+                 **kwargs):
         """
         Initialize the redis module
 
         :host: Host that redis is running on
         :port: Port to connect to
         :db:   Id of the DB to use
+        :flushInterval: Maximum seconds between flushes
+        :flushSize:     Number of pending writes that triggers a flush
+        :spoolPath:     File to spill to during outages, defaults to one in
+                        the temp directory. Worker processes append
+                        -<index> to the name, they each need their own
+        :spoolMemory:   Bytes to buffer in memory during an outage
+        :spoolFile:     Bytes to allow in the spill file
+        :replayBatch:   Writes per pipeline when replaying the spool
+        :retryMax:      Maximum seconds between connection attempts
+        :history:          Record time-series history
+        :historyRetention: Points to keep per tier (raw, 1m, 1h)
+
+        For the other options see `Module.__init__`
         """
 
+        Module.__init__(self, **kwargs)
+
         self.host = host
         self.port = port
         self.db   = db
 
+        self.flushInterval = flushInterval
+        self.flushSize     = flushSize
+        self.replayBatch   = replayBatch
+
         # Setup the redis API
         self.redis = redis.StrictRedis(host = host, port = port, db = db)
 
-        self.disconnectedCache = {}
+        # Hash name -> data waiting to be written, and history commands
+        self.pending  = {}
+        self.appends  = []
+        self.flushNow = Event()
+
+        self.history = History(historyRetention) if history else None
+
+        if spoolPath is None:
+            spoolPath = os.path.join(tempfile.gettempdir(),
+                "xstats-redis-{}-{}-{}.spool".format(host, port, db))
+
+        self.breaker = CircuitBreaker(Backoff(maximum = retryMax))
+
+        # Created in `start`, once the worker index is known
+        self.spoolPath   = spoolPath
+        self.spoolMemory = spoolMemory
+        self.spoolFile   = spoolFile
+        self.spool       = None
+
+        # Totals, `coalesced` counts updates folded into a pending write
+        self.written   = 0
+        self.coalesced = 0
 
         self.log = logger.name("redis") \
                          .fields(host = host, port = port, db = db)
 
+    def start(self):
+        """Open the spool and spawn the flush loop"""
+
+        spoolPath = self.spoolPath
+        if self.publisher.index is not None:
+            base, extension = os.path.splitext(spoolPath)
+            spoolPath = "{}-{}{}".format(base, self.publisher.index, extension)
+
+        self.spool = OutageSpool(spoolPath, self.spoolMemory, self.spoolFile)
+
+        group = self.metricGroup("redis")
+
+        registry.gauge(group, "pending", lambda: len(self.pending))
+        registry.gauge(group, "spooled", lambda: len(self.spool))
+        registry.gauge(group, "spool-corrupt", lambda: self.spool.corrupt)
+        registry.gauge(group, "written", lambda: self.written)
+        registry.gauge(group, "coalesced", lambda: self.coalesced)
+        registry.gauge(group, "outage", lambda: int(self.breaker.isOpen()))
+
+        gevent.spawn(self._flushLoop)
+
     def push(self, packet):
         """
-        Push data to redis, if a connection can't be established store the data
-        in the cache until we can successfully connect.
+        Queue data for the next flush
 
         :data: Data to push
         """
@@ -146,39 +1540,308 @@ class RedisModule(Module):
 
         self.log.debug("Setting {}:{}", keyName, packet["data"])
 
-        try:
-            self.redis.hmset(keyName, packet["data"])
-            self.flushCache()
-        except RedisConnectionError:
-            self.log.warning("Can't connect to Redis, caching '{}'", keyName)
-            self.disconnectedCache[keyName] = packet["data"]
+        pending = self.pending.get(keyName)
+        if pending is None:
+            self.pending[keyName] = dict(packet["data"])
+        else:
+            pending.update(packet["data"])
+            self.coalesced += 1
+
+        if self.history:
+            self.appends.extend(self.history.commands(
+                keyName, packet["timestamp"], packet["data"]
+            ))
+
+        if len(self.pending) + len(self.appends) >= self.flushSize:
+            self.flushNow.set()
+
+    def _flushLoop(self):
+        """Flush every `flushInterval` or when woken up by `push`"""
+
+        while True:
+            self.flushNow.wait(self.flushInterval)
+            self.flushNow.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                self.log.trace('error').error("Flush failed: {}", e)
+
+    def execute(self, commands):
+        """
+        Run `commands` in a single pipeline
 
-    def flushCache(self):
+        :commands: List of [command, arg1, arg2, ...] lists
         """
-        Flush the disconnectedCache if there's anything in it, unless it fails
-        then keep as is.
+
+        pipeline = self.redis.pipeline(transaction = False)
+        for command in commands:
+            getattr(pipeline, command[0])(*command[1:])
+
+        pipeline.execute()
+
+    def outage(self, error):
+        """Open the circuit breaker after a failed write"""
+
+        delay = self.breaker.failure()
+
+        self.log.warning("Can't connect to Redis ({}), retrying in {:.1f}s, "
+                         "{} writes spooled", error, delay, len(self.spool))
+
+    def flush(self):
         """
+        Write all pending data in one pipeline, going through the spool if
+        redis is down or the spool is still being replayed.
+        """
+
+        if not self.pending and not self.appends and not self.spool:
+            return
+
+        pending, self.pending = self.pending, {}
+        appends, self.appends = self.appends, []
+
+        commands = [["hmset", key, data]
+                        for key, data in pending.iteritems() if data]
+        commands.extend(appends)
+
+        # Keep the order of writes while redis is down or catching up
+        if self.breaker.isOpen() or self.spool:
+            for command in commands:
+                self.spool.append(command)
+
+            if self.breaker.allow():
+                self.replay()
+
+            return
+
+        try:
+            self.execute(commands)
+        except RedisConnectionError as e:
+            for command in commands:
+                self.spool.append(command)
 
-        if len(self.disconnectedCache) == 0:
+            self.outage(e)
             return
+        except ResponseError as e:
+            # The rest of the pipeline still ran, retrying won't help
+            self.log.error("Redis rejected a write: {}", e)
+
+        self.written += len(commands)
+
+        self.log.debug("Flushed {} writes ({} updates coalesced so far)",
+                       len(commands), self.coalesced)
+
+    def replay(self):
+        """
+        Replay the spool in pipelined batches, until it's empty or redis
+        fails again
+        """
+
+        self.log.info("Replaying {} spooled writes", len(self.spool))
+
+        while self.spool:
+            commands = self.spool.peek(self.replayBatch)
 
-        self.log.info("Flushing cache...")
+            try:
+                self.execute(commands)
+            except RedisConnectionError as e:
+                self.outage(e)
+                return
+            except ResponseError as e:
+                # The rest of the batch still ran, a rejected write would
+                # block the spool forever if it was kept
+                self.log.error("Redis rejected a spooled write, dropping "
+                               "it: {}", e)
 
-        pipeline = self.redis.pipeline()
-        for key, data in self.disconnectedCache.iteritems():
-            self.log.debug(" * Flushing {}", key)
-            pipeline.hmset(key, data)
+            self.spool.commit(len(commands))
+            self.breaker.success()
 
-        self.disconnectedCache = {}
+            self.written += len(commands)
+
+            # Let ingestion run between batches
+            gevent.sleep(0)
+
+        if self.spool.dropped:
+            self.log.warning("Spool was full, {} writes were dropped",
+                             self.spool.dropped)
+            self.spool.dropped = 0
+
+        self.log.info("Spool replayed")
 
 class Publisher(BasePublisher):
+    # Packets published, every entry of a batch counts
+    published = registry.meter("ingest", "published")
+
+    def __init__(self, index = None):
+        """
+        :index: Worker process index, None for the main process
+        """
+
+        self.index = index
+
+        # Latest data of every host/module, to rebuild delta packets and
+        # for modules that want the current state
+        self.store = LatestStore()
+
+        self.log = logger.name("publisher")
+
+        BasePublisher.__init__(self)
+
+    def addModule(self, module):
+        module.publisher = self
+
+        BasePublisher.addModule(self, module)
+
+    def start(self):
+        for module in self.modules:
+            module.startWorkers()
+
+        BasePublisher.start(self)
+
     def publish(self, data):
         for module in self.modules:
-            module.push(data)
+            module.enqueue((data, ))
+
+    def publishMany(self, packets):
+        for module in self.modules:
+            module.enqueue(packets)
+
+    def unpackBatch(self, data):
+        """
+        Split a batch packet into regular packets, every entry inherits the
+        batch's top level fields (host, timestamp, ...)
+
+        :data: Batch packet
+        :returns: List of packets
+        """
+
+        batch   = data.pop("batch")
+        packets = []
+
+        for entry in batch:
+            packet = data.copy()
+            packet.update(entry)
+            packets.append(packet)
+
+        return packets
+
+    def expand(self, packet):
+        """
+        Rebuild the full data of a delta packet from the last known state of
+        its host/module, so modules always see complete data, and record it
+        as the latest state.
+
+        :packet: Packet to expand
+        :returns: Packet with the full data, None if it's a delta for which
+                  no keyframe was received yet
+        """
+
+        host   = packet.get("host")
+        module = packet["module"]
+
+        if packet.pop("delta", False):
+            data = self.store.get(host, module)
+            if data is None:
+                self.log.debug("Dropping delta for {}-{}, waiting for "
+                               "keyframe", host, module)
+                return None
 
-    def parse(self, packet):
-        data = ujson.loads(packet)
-        self.publish(data)
+            data.update(packet["data"])
+            packet["data"] = data
+
+        self.store.update(host, module, packet.get("timestamp"),
+                          packet["data"])
+
+        return packet
+
+    def handle(self, data):
+        """
+        Publish a decoded packet, unpacking it if it's a batch
+
+        :data: Decoded packet
+        """
+
+        if "batch" in data:
+            packets = [packet for packet in map(self.expand,
+                                                self.unpackBatch(data))
+                            if packet is not None]
+
+            if packets:
+                self.published.mark(len(packets))
+                self.publishMany(packets)
+        else:
+            packet = self.expand(data)
+
+            if packet is not None:
+                self.published.mark()
+                self.publish(packet)
+
+def serveMetrics(host, port):
+    """
+    Serve the metrics of this process as JSON at http://host:port/metrics,
+    in a greenlet
+
+    :host: Host(IP) to listen on
+    :port: Port to listen on
+    """
+
+    app = Bottle()
+
+    @app.get('/metrics')
+    def metrics():
+        return registry.snapshot()
+
+    gevent.spawn(run, app, host = host, port = port, server = "gevent",
+                 quiet = True)
+
+def reportMetrics(publisher, host, interval):
+    """
+    Publish the metrics of this process every `interval` seconds, as if
+    they came from a reporter named `host` with an "aggregator-<group>"
+    module per metric group
+
+    :publisher: Publisher to publish to
+    :host:      Host name to publish as
+    :interval:  Seconds between reports
+    """
+
+    while True:
+        gevent.sleep(interval)
+
+        batch = [
+            {"module": "aggregator-{}".format(group), "data": data}
+                for group, data in registry.snapshot().iteritems()
+                    # A key per reporter is too much for the dashboard
+                    if group != "sessions" and data
+        ]
+
+        if batch:
+            publisher.handle({"host": host, "timestamp": int(time.time()),
+                              "batch": batch})
+
+def startMetrics(config, publisher, index = None):
+    """
+    Start the metrics endpoint and reporting, as configured
+
+    :config:    Aggregator config
+    :publisher: Publisher to report to
+    :index:     Worker process index, None for the main process. Workers
+                use the port after the main process's plus their index and
+                report as <metricsHost>-<index>
+    """
+
+    port = config["metricsPort"]
+    host = config["metricsHost"]
+
+    if index is not None:
+        port = port and port + 1 + index
+        host = host and "{}-{}".format(host, index)
+
+    if port:
+        serveMetrics(config["metricsIp"], port)
+
+    if host:
+        gevent.spawn(reportMetrics, publisher, host, config["metricsInterval"])
 
 def moduleFinder(name):
     moduleName = "{}Module".format(name)
@@ -186,6 +1849,151 @@ def moduleFinder(name):
     moduleClass = getattr(sys.modules[__name__], moduleName)
     return moduleClass
 
+def splitModules(modules):
+    """
+    Split a modules config into the modules that have to run in a single
+    (designated) process and the ones every worker process runs.
+
+    :modules: Modules config, module name -> list of configs
+    :returns: (shared, local) modules configs
+    """
+
+    shared = {}
+    local  = {}
+
+    for moduleName, moduleConfigs in modules.iteritems():
+        if moduleFinder(moduleName).shared:
+            shared[moduleName] = moduleConfigs
+        else:
+            local[moduleName] = moduleConfigs
+
+    return shared, local
+
+def runServer(config, modules, channel = None, reusePort = False,
+              index = None):
+    """
+    Load `modules` and serve reporters until the server stops
+
+    :config:    Aggregator config
+    :modules:   Modules config to load
+    :channel:   Socket to the designated process, packets are forwarded to
+                it if given
+    :reusePort: Bind the reporter port with SO_REUSEPORT
+    :index:     Worker process index, None if not a worker
+    """
+
+    publisher = Publisher(index)
+
+    # Load modules based on config
+    loadModulesFromConfig({"modules": modules}, publisher, moduleFinder)
+
+    if channel is not None:
+        session = network.Session(channel, ("designated", config["port"]))
+        session.start()
+
+        publisher.addModule(ChannelModule(session))
+
+    # Create server
+    server = Server(config["port"], publisher, config["protocols"],
+                    reusePort, config["acceptRate"], config["maxHandshakes"],
+                    config["retryAfter"], config["compression"],
+                    config["handshakeTimeout"])
+
+    publisher.start()
+    server.listen()
+
+    startMetrics(config, publisher, index)
+
+    if config["udpPort"]:
+        datagramServer = network.DatagramServer(config["udpPort"],
+                                                reusePort = reusePort)
+        datagramServer.packetHandler = publisher.handle
+        datagramServer.listen()
+
+        registry.gauge("ingest", "udp-received",
+                       lambda: datagramServer.received)
+        registry.gauge("ingest", "udp-truncated",
+                       lambda: datagramServer.truncated)
+        registry.gauge("ingest", "udp-malformed",
+                       lambda: datagramServer.malformed)
+
+    # Wait for the server to finish up
+    server.serverGreenlet.join()
+
+def startWorkers(config):
+    """
+    Run `config["processes"]` worker processes that share the reporter port
+    through SO_REUSEPORT, while this process runs the shared modules.
+
+    A reporter's connection lives in a single worker, so per host state
+    (deltas, redis writes) stays in one place. Reporters send a keyframe
+    after reconnecting, so landing on another worker afterwards is fine.
+    Workers forward every packet to this process over a socketpair.
+    """
+
+    shared, local = splitModules(config["modules"])
+
+    log = logger.name("workers")
+
+    channels = []
+    pids     = set()
+
+    for index in xrange(config["processes"]):
+        parentSocket, childSocket = socketpair() if shared else (None, None)
+
+        pid = gevent.fork()
+
+        if pid == 0:
+            # Only keep our own end of our own channel
+            for channel in channels + [parentSocket]:
+                if channel is not None:
+                    channel.close()
+
+            status = 0
+
+            try:
+                runServer(config, local, childSocket, reusePort = True,
+                          index = index)
+            except Exception as e:
+                log.trace('error').error("Worker {} failed: {}", index, e)
+                status = 1
+
+            os._exit(status)
+
+        if childSocket is not None:
+            childSocket.close()
+            channels.append(parentSocket)
+
+        pids.add(pid)
+
+    log.info("Started {} workers", len(pids))
+
+    # Run the shared modules, fed by the workers
+    publisher = Publisher()
+    loadModulesFromConfig({"modules": shared}, publisher, moduleFinder)
+
+    for index, channel in enumerate(channels):
+        session = network.Session(channel, ("worker", index))
+        session.packetHandler = publisher.handle
+        session.start()
+
+    publisher.start()
+
+    startMetrics(config, publisher)
+
+    # Wait until all workers are gone
+    while pids:
+        gevent.sleep(1)
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            break
+
+        if pid:
+            log.error("Worker {} exited with status {}", pid, status)
+            pids.discard(pid)
+
 def start(args):
     """
     Starts the aggregator
@@ -193,12 +2001,22 @@ def start(args):
     :port: Port to listen on for reporters
     """
 
-    publisher = Publisher()
-
     defaults = {
-        'ip'     : '127.0.0.1',
-        'port'   : 13337,
-        'modules': {
+        'ip'              : '127.0.0.1',
+        'port'            : 13337,
+        'protocols'       : ['json', 'binary'],
+        'compression'     : ['zlib'],
+        'processes'       : 1,
+        'udpPort'         : None,
+        'acceptRate'      : None,
+        'maxHandshakes'   : None,
+        'retryAfter'      : 5,
+        'handshakeTimeout': 30,
+        'metricsIp'       : '127.0.0.1',
+        'metricsPort'     : 13338,
+        'metricsHost'     : None,
+        'metricsInterval' : 10,
+        'modules'         : {
             'Redis': [
                 {}
             ],
@@ -215,19 +2033,11 @@ def start(args):
     else:
         config = defaults
 
-    # Load modules based on config
-    loadModulesFromConfig(config, publisher, moduleFinder)
-
     # If args.port override other port config
     if args.port:
         config["port"] = args.port
 
-
-    # Create server
-    server = Server(config["port"], publisher)
-
-    publisher.start()
-    server.listen()
-
-    # Wait for the server to finish up
-    server.serverGreenlet.join()
+    if config["processes"] > 1:
+        startWorkers(config)
+    else:
+        runServer(config, config["modules"])
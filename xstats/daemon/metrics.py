@@ -0,0 +1,235 @@
+"""
+Self-instrumentation, counters, meters and latency histograms cheap enough
+to leave on in production. Metrics are registered in groups, a group's
+values are read as a flat dictionary so it can be published like the data
+of any other module.
+"""
+
+import bisect
+import time
+
+from collections import OrderedDict
+
+class Counter(object):
+    """Value that only goes up"""
+
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def increment(self, amount = 1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+class Meter(object):
+    """Counts events and their rate over the last complete second"""
+
+    __slots__ = ('second', 'current', 'previous', 'total')
+
+    def __init__(self):
+        self.second   = 0
+        self.current  = 0
+        self.previous = 0
+        self.total    = 0
+
+    def mark(self, amount = 1):
+        second = int(time.time())
+
+        if second != self.second:
+            self.previous = self.current if second == self.second + 1 else 0
+            self.second   = second
+            self.current  = 0
+
+        self.current += amount
+        self.total   += amount
+
+    def rate(self):
+        """Events in the last complete second"""
+
+        second = int(time.time())
+
+        if second == self.second:
+            return self.previous
+        if second == self.second + 1:
+            return self.current
+
+        return 0
+
+    def read(self):
+        return {"rate": self.rate(), "total": self.total}
+
+class Gauge(object):
+    """Value read from `function` whenever the metrics are read"""
+
+    __slots__ = ('function', )
+
+    def __init__(self, function):
+        self.function = function
+
+    def read(self):
+        return self.function()
+
+class Histogram(object):
+    """
+    Distribution of durations (or other values) in fixed buckets. Only the
+    last one or two `window`s are kept, so the percentiles follow changes
+    instead of averaging over the whole uptime.
+    """
+
+    # Bucket upper bounds in seconds, 10us to 10s
+    defaultBounds = tuple(
+        base * 10 ** exponent for exponent in xrange(-5, 1)
+                                  for base in (1, 2, 5)
+    ) + (10, )
+
+    def __init__(self, bounds = None, window = 60):
+        """
+        :bounds: Sorted bucket upper bounds, anything above the last one
+                 goes into an overflow bucket
+        :window: Seconds per window
+        """
+
+        self.bounds = tuple(bounds or self.defaultBounds)
+        self.window = window
+
+        self.current  = self._empty()
+        self.previous = self._empty()
+
+        self.rotateAt = time.time() + window
+
+    def _empty(self):
+        # [bucket counts, count, sum, max]
+        return [[0] * (len(self.bounds) + 1), 0, 0.0, 0.0]
+
+    def _rotate(self, now):
+        if now >= self.rotateAt + self.window:
+            # Idle for over a window, nothing recent to keep
+            self.previous = self._empty()
+        else:
+            self.previous = self.current
+
+        self.current  = self._empty()
+        self.rotateAt = now + self.window
+
+    def observe(self, value):
+        """Record a value"""
+
+        now = time.time()
+        if now >= self.rotateAt:
+            self._rotate(now)
+
+        window = self.current
+
+        window[0][bisect.bisect_left(self.bounds, value)] += 1
+        window[1] += 1
+        window[2] += value
+
+        if value > window[3]:
+            window[3] = value
+
+    def since(self, started):
+        """Record the time passed since `started` (a `time.time()`)"""
+
+        self.observe(time.time() - started)
+
+    def percentile(self, buckets, count, maximum, fraction):
+        """
+        Upper bound of the bucket holding the `fraction` percentile, the
+        maximum for the overflow bucket
+        """
+
+        wanted = fraction * count
+        seen   = 0
+
+        for index, bucketCount in enumerate(buckets):
+            seen += bucketCount
+
+            if seen >= wanted:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], maximum)
+
+                break
+
+        return maximum
+
+    def read(self):
+        now = time.time()
+        if now >= self.rotateAt:
+            self._rotate(now)
+
+        buckets = [a + b for a, b in zip(self.previous[0], self.current[0])]
+        count   = self.previous[1] + self.current[1]
+        total   = self.previous[2] + self.current[2]
+        maximum = max(self.previous[3], self.current[3])
+
+        if not count:
+            return {"count": 0, "mean": 0, "p50": 0, "p99": 0, "max": 0}
+
+        return {
+            "count": count,
+            "mean" : total / count,
+            "p50"  : self.percentile(buckets, count, maximum, 0.5),
+            "p99"  : self.percentile(buckets, count, maximum, 0.99),
+            "max"  : maximum,
+        }
+
+class Registry(object):
+    """Named metrics, grouped"""
+
+    def __init__(self):
+        # (group, name) -> metric
+        self.metrics = OrderedDict()
+
+    def _get(self, group, name, factory):
+        metric = self.metrics.get((group, name))
+
+        if metric is None:
+            metric = self.metrics[(group, name)] = factory()
+
+        return metric
+
+    def counter(self, group, name):
+        return self._get(group, name, Counter)
+
+    def meter(self, group, name):
+        return self._get(group, name, Meter)
+
+    def histogram(self, group, name, **kwargs):
+        return self._get(group, name, lambda: Histogram(**kwargs))
+
+    def gauge(self, group, name, function):
+        """Register a gauge, replacing an earlier one of the same name"""
+
+        gauge = self.metrics[(group, name)] = Gauge(function)
+        return gauge
+
+    def remove(self, group, name):
+        self.metrics.pop((group, name), None)
+
+    def snapshot(self):
+        """
+        Read every metric
+
+        :returns: Dictionary of group -> flat dictionary of values, metrics
+                  with several values get their keys appended ("push-p99")
+        """
+
+        groups = OrderedDict()
+
+        for (group, name), metric in self.metrics.items():
+            values = groups.setdefault(group, {})
+            value  = metric.read()
+
+            if isinstance(value, dict):
+                for key, subValue in value.iteritems():
+                    values["{}-{}".format(name, key)] = subValue
+            else:
+                values[name] = value
+
+        return groups
+
+# Metrics of this process
+registry = Registry()
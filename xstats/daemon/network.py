@@ -1,13 +1,43 @@
+import random
+import time
+import zlib
+
 import gevent
 
 from gevent.event import Event
 from gevent.server import StreamServer
 from gevent.socket import create_connection
-from gevent.queue import Queue
 from gevent import socket
 
+from protocol import JsonProtocol, ProtocolError, InflatingReader, \
+                     protocols, compressions, hello, negotiate
+from shared import Backoff, TokenBucket
+from spool import SendSpool
+
 from twiggy import log; logger = log.name(__name__)
 
+def bind(port, kind = socket.SOCK_STREAM, reusePort = False):
+    """
+    Create a socket bound to `port` on all interfaces
+
+    :port:      Port to bind to
+    :kind:      Socket type, SOCK_STREAM or SOCK_DGRAM
+    :reusePort: Bind with SO_REUSEPORT, so several processes can bind to
+                `port` and the kernel spreads the traffic over them
+    """
+
+    bound = socket.socket(socket.AF_INET, kind)
+    bound.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reusePort:
+        # Not exposed by the socket module on older pythons, 15 on Linux
+        bound.setsockopt(socket.SOL_SOCKET,
+                         getattr(socket, "SO_REUSEPORT", 15), 1)
+
+    bound.bind(("0.0.0.0", port))
+
+    return bound
+
 class DisconnectedException(Exception):
     """
     Exception thrown when session gets disconnected, used to stop loops
@@ -15,6 +45,17 @@ class DisconnectedException(Exception):
 
     pass
 
+class RetryLater(Exception):
+    """
+    Exception thrown when the server turned a connection away, asking to
+    retry after `delay` seconds
+    """
+
+    def __init__(self, delay):
+        Exception.__init__(self, "Server asked to retry after {} seconds"
+                                 .format(delay))
+        self.delay = delay
+
 class Session(object):
     """
     Base class for network connections (sessions)
@@ -24,15 +65,36 @@ class Session(object):
     # if None don't call
     packetHandler = None
 
-    def __init__(self, socket = None, address = None):
+    # Most packets to write to the socket at once
+    sendBatch = 100
+
+    # Packets per second to send while working through a backlog, None for
+    # as fast as possible
+    replayRate = None
+
+    # `metrics.Histogram` to record decode times in, if not None
+    decodeTimer = None
+
+    def __init__(self, socket = None, address = None, spool = None):
         """
         Initialize a `Session`
 
         :socket: Socket to use for this session
         :address: Address the socket is connected to/from
+        :spool: `SendSpool` to queue packets in, unbounded if None
         """
 
-        self.sendQueue = Queue()
+        self.sendQueue = spool if spool is not None else SendSpool()
+
+        # Sessions start out as uncompressed JSON, a handshake can switch
+        # protocols and enable compression
+        self.protocol   = JsonProtocol()
+        self.sockfile   = None
+        self.compressor = None
+
+        # Bytes sent before (raw) and after (wire) compression
+        self.sentRaw  = 0
+        self.sentWire = 0
 
         self.recvGreenlet = None
         self.sendGreenlet = None
@@ -46,26 +108,48 @@ class Session(object):
         self.log = logger.name("session") \
                          .fields(host = address[0], port = address[1])
 
-    def _sendPacket(self, packet):
+    def _sendPackets(self, packets):
         """
-        Send a packet, writing it to the socket
+        Send packets, writing them to the socket in one go
 
-        `_sendLoop` will stop if this does not return True
+        `_sendLoop` will stop if this does not return True, the packets
+        are left in the spool to be sent again after a reconnect
         """
 
+        data = []
+        for packet in packets:
+            try:
+                data.append(self.protocol.encode(packet))
+            except ProtocolError as e:
+                # Can't ever be sent, drop it
+                self.log.error("_sendPackets can't encode {}: {}", packet, e)
+
+        data = "".join(data)
+        self.sentRaw += len(data)
+
+        # One sync flush per batch, the peer can decode everything sent
+        # so far while the compression context carries over
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + \
+                   self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.sentWire += len(data)
+
         try:
-            self.log.debug("Sending packet: {}", packet)
-            self.socket.sendall("{}\n".format(packet))
-            self.log.debug("Sent packet: {}", packet)
+            self.log.debug("Sending {} packets", len(packets))
+            self.socket.sendall(data)
         except socket.error as e:
-            # If an error occurs put packet back on the queue
-            self.log.error("_sendPacket error: {}", e)
+            self.log.error("_sendPackets error: {}", e)
             self.disconnect()
-            self.sendQueue.put(packet)
             return False
 
         return True
 
+    def _sendPacket(self, packet):
+        """Send a single packet, see `_sendPackets`"""
+
+        return self._sendPackets([packet])
+
     def _sendLoop(self):
         """Loop for sending packets"""
 
@@ -73,9 +157,19 @@ class Session(object):
 
         try:
             while True:
-                packet = self.sendQueue.get()
-                if not self._sendPacket(packet):
+                self.sendQueue.wait()
+
+                # Only removed from the spool once they're out, a failed
+                # send keeps them in front, in order
+                sequence, packets = self.sendQueue.peek(self.sendBatch)
+                if not self._sendPackets(packets):
                     break
+
+                self.sendQueue.commit(sequence)
+
+                # Catching up after an outage, don't flood the server
+                if self.replayRate and len(self.sendQueue):
+                    gevent.sleep(len(packets) / float(self.replayRate))
         except DisconnectedException:
             self.log.debug("_sendLoop killed")
         finally:
@@ -91,15 +185,14 @@ class Session(object):
         """
 
         self.log.debug("Queueing packet: {}", packet)
-        self.sendQueue.put(packet)
+        self.sendQueue.append(packet)
 
     def _recvPacket(self, packet):
         """
         Internal method for receiving a packet
 
-        :packet: Packet received
+        :packet: Packet received, decoded by the session's protocol
         """
-        packet = packet[:-1] # Remove trailing newline
 
         self.log.debug("Packet received: {}", packet)
 
@@ -110,21 +203,33 @@ class Session(object):
         """Loop for receiving packets"""
 
         self.log.debug("Starting recv loop...")
-        sockfile = self.socket.makefile()
 
-        while True:
-            try:
-                packet = sockfile.readline()
-            except socket.error as e:
-                self.log.error("_recvLoop, exception: {}", e)
-                self.disconnect()
-                break
-
-            # Stop if packet is None
-            if not packet:
-                break
+        if self.sockfile is None:
+            self.sockfile = self.socket.makefile()
 
-            self._recvPacket(packet)
+        try:
+            if self._negotiate():
+                while True:
+                    frame = self.protocol.readFrame(self.sockfile)
+
+                    # Stop if frame is None
+                    if frame is None:
+                        break
+
+                    if self.decodeTimer is None:
+                        packet = self.protocol.decode(frame)
+                    else:
+                        started = time.time()
+                        packet  = self.protocol.decode(frame)
+                        self.decodeTimer.since(started)
+
+                    self._recvPacket(packet)
+        except socket.error as e:
+            self.log.error("_recvLoop, exception: {}", e)
+            self.disconnect()
+        except ProtocolError as e:
+            self.log.error("_recvLoop, protocol error: {}", e)
+            self.disconnect()
 
         # Only error level if not clean exit
         if not self.cleanExit:
@@ -135,6 +240,39 @@ class Session(object):
         self.onDisconnect()
         self.log.debug("Recv loop stopped")
 
+    def _negotiate(self):
+        """
+        Called by the recv loop before reading packets, to handle a
+        handshake if the protocol has one
+
+        :returns: False if the connection closed during the handshake
+        """
+
+        return True
+
+    def _compress(self, name):
+        """
+        Compress the stream in both directions from here on
+
+        :name: Compression, see `protocol.compressions`
+        """
+
+        compressor, decompressor = compressions[name]
+
+        self.compressor = compressor()
+        self.sockfile   = InflatingReader(self.socket, decompressor())
+
+    def byteCounts(self):
+        """Bytes before (raw) and after (wire) compression"""
+
+        counts = {"sent-raw": self.sentRaw, "sent-wire": self.sentWire}
+
+        if isinstance(self.sockfile, InflatingReader):
+            counts["received-raw"]  = self.sockfile.rawBytes
+            counts["received-wire"] = self.sockfile.wireBytes
+
+        return counts
+
     def start(self):
         """Starts the recv and send loops"""
 
@@ -179,6 +317,67 @@ class ServerSession(Session):
 
         Session.__init__(self, socket, address)
 
+    def _negotiate(self):
+        """
+        Handle the optional handshake, a client that starts without one is
+        an old reporter and talks JSON.
+        """
+
+        try:
+            return self._handshake()
+        finally:
+            self.server.handshakeDone()
+
+    def _handshake(self):
+        """Read the first line and answer a hello, see `_negotiate`"""
+
+        # Don't let a silent client hold a handshake slot forever. A socket
+        # timeout wouldn't reach the sockfile, it reads from its own socket
+        line = None
+        with gevent.Timeout(self.server.handshakeTimeout, False):
+            line = self.sockfile.readline()
+
+        if line is None:
+            self.log.warning("No handshake within {} seconds, disconnecting",
+                             self.server.handshakeTimeout)
+
+            # Drop the sockfile's socket too, or the connection stays open
+            self.sockfile.close()
+            self.disconnect()
+            return False
+
+        if not line:
+            return False
+
+        packet = self.protocol.decode(line)
+
+        if not isinstance(packet, dict) or "hello" not in packet:
+            self._recvPacket(packet)
+            return True
+
+        offered = packet["hello"].get("protocols", [])
+        name    = negotiate(offered, self.server.protocols)
+
+        reply = {"protocol": name}
+
+        # Old clients don't offer compression and stay uncompressed
+        compression = None
+        for offer in packet["hello"].get("compression", []):
+            if offer in self.server.compression and offer in compressions:
+                compression = reply["compression"] = offer
+                break
+
+        self.log.debug("Negotiated protocol {}, compression {} (offered: {})",
+                       name, compression, packet["hello"])
+
+        self.socket.sendall(self.protocol.encode(reply))
+        self.protocol = protocols[name]()
+
+        if compression is not None:
+            self._compress(compression)
+
+        return True
+
     def _recvLoop(self):
         """Modified `_recvLoop` to let the `Server` handle disconnects properly"""
 
@@ -193,15 +392,62 @@ class Server(object):
     # What to use as session factory
     session = ServerSession
 
-    def __init__(self, port):
+    # Protocols clients can negotiate
+    protocols = ("json", "binary")
+
+    # Stream compressions clients can negotiate
+    compression = ("zlib", )
+
+    # Pending connections the kernel queues for us
+    backlog = 256
+
+    def __init__(self, port, protocols = None, reusePort = False,
+                 acceptRate = None, maxHandshakes = None, retryAfter = 5,
+                 compression = None, handshakeTimeout = 30):
         """
         Initialize the `Server`
 
         :port: Port to listen on
+        :protocols: Protocols clients can negotiate, JSON is always accepted
+        :reusePort: Bind with SO_REUSEPORT, so several processes can listen
+                    on `port` and the kernel spreads connections over them
+        :acceptRate: Connections per second to accept, None for no limit
+        :maxHandshakes: Connections allowed to be handshaking at once, None
+                        for no limit
+        :retryAfter: Seconds clients that are turned away are told to wait,
+                     spread out up to twice that
+        :compression: Stream compressions clients can negotiate,
+                      uncompressed is always accepted
+        :handshakeTimeout: Seconds a client gets to send its hello (or
+                           first packet) before it's disconnected, None
+                           for no limit
         """
 
+        if protocols is not None:
+            self.protocols = tuple(protocols)
+
+        if compression is not None:
+            self.compression = tuple(compression)
+
         self.port = port
-        self.server = StreamServer(("0.0.0.0", port), self.handleConnect)
+
+        self.acceptLimit   = TokenBucket(acceptRate) if acceptRate else None
+        self.maxHandshakes = maxHandshakes
+        self.retryAfter    = retryAfter
+
+        self.handshakeTimeout = handshakeTimeout
+
+        # Sessions that haven't finished their handshake yet
+        self.handshaking = 0
+        self.rejected    = 0
+
+        if reusePort:
+            listener = bind(port, socket.SOCK_STREAM, reusePort)
+            listener.listen(self.backlog)
+        else:
+            listener = ("0.0.0.0", port)
+
+        self.server = StreamServer(listener, self.handleConnect)
         self.serverGreenlet = None
 
         self.sessions = set()
@@ -223,14 +469,60 @@ class Server(object):
         :address: (ip, port) tuple of the remote client
         """
 
+        if not self.admit():
+            self.reject(socket, address)
+            return
+
         self.log.info("Client connected from {}:{}", address[0], address[1])
 
+        self.handshaking += 1
+
         session = self.session(self, socket, address)
         session.start()
 
         # Add session to active sessions
         self.sessions.add(session)
 
+    def admit(self):
+        """Whether a new connection is within the limits"""
+
+        if self.maxHandshakes is not None and \
+           self.handshaking >= self.maxHandshakes:
+            return False
+
+        if self.acceptLimit is not None and not self.acceptLimit.take():
+            return False
+
+        return True
+
+    def reject(self, connection, address):
+        """
+        Turn a connection away, telling the client when to retry
+
+        :connection: Socket object for the connection
+        :address: (ip, port) tuple of the remote client
+        """
+
+        self.rejected += 1
+
+        # Spread the retries, so they don't come back all at once
+        delay = round(random.uniform(self.retryAfter, 2 * self.retryAfter), 1)
+
+        self.log.debug("Rejecting {}:{}, retry after {} seconds",
+                       address[0], address[1], delay)
+
+        try:
+            connection.sendall(JsonProtocol().encode({"retry-after": delay}))
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def handshakeDone(self):
+        """Called by a session once its handshake finished (or failed)"""
+
+        self.handshaking -= 1
+
     def handleDisconnect(self, session):
         """
         Handle a client disconnecting
@@ -252,19 +544,117 @@ class Server(object):
             session.send(packet)
 
 class Client(Session):
-    """Client specific extension to `Session` including reconnect"""
+    """
+    Client specific extension to `Session` including reconnect
+
+    Reconnects back off exponentially with full jitter, so a crowd of
+    clients that lost their server doesn't come back all at once. A
+    retry-after hint from the server is always waited out.
+
+    Given several addresses the first one is the primary and the others
+    are tried in order when it can't be reached, the client only waits
+    after all of them failed. While connected to a failover the primary
+    is probed every `failbackInterval` seconds and the client moves back
+    once it's reachable.
+    """
+
+    # Seconds between checks whether the primary is back, None to stay on
+    # the failover
+    failbackInterval = 60
+
+    # Method to call after every successful (re)connect
+    # if None don't call
+    connectHandler = None
+
+    # Method to call when the connection is lost (or shut down), before
+    # reconnecting
+    # if None don't call
+    disconnectHandler = None
 
-    # How long to wait between reconnect intervals
-    retryInterval = 5
+    # Protocols to offer in the handshake, in order of preference. Plain
+    # JSON without a handshake (for old aggregators) if only "json" and no
+    # compression
+    protocols = ("json", )
 
-    def __init__(self, address):
+    # Stream compressions to offer, in order of preference
+    compression = ()
+
+    def __init__(self, address, protocols = None, spool = None,
+                 replayRate = None, backoff = None, failbackInterval = None,
+                 compression = None):
         """
         Initialize the client
 
-        :address: (host, port) tuple to connect to
+        :address: (host, port) tuple to connect to, or a list of them in
+                  order of preference
+        :protocols: Protocols to offer, in order of preference
+        :spool: `SendSpool` holding packets while disconnected, unbounded
+                if None
+        :replayRate: Packets per second to replay a backlog at after a
+                     reconnect, None for no limit
+        :backoff: `Backoff` for the delay between reconnects
+        :failbackInterval: Seconds between checks whether the primary is
+                           back, see `failbackInterval`
+        :compression: Stream compressions to offer, in order of preference
+        """
+
+        if protocols is not None:
+            self.protocols = tuple(protocols)
+
+        if compression is not None:
+            self.compression = tuple(compression)
+
+        if failbackInterval is not None:
+            self.failbackInterval = failbackInterval
+
+        self.addresses = list(address) if isinstance(address, list) \
+                            else [address]
+
+        self.backoff = backoff or Backoff(1, 60, 2, jitter = True)
+
+        # Delay the server asked for when it turned us away
+        self.retryAfter = None
+
+        if replayRate is not None:
+            self.replayRate = replayRate
+
+        Session.__init__(self, address = self.addresses[0], spool = spool)
+
+    def _handshake(self):
+        """
+        Offer our protocols to the server
+
+        :returns: Protocol instance to use for this connection
         """
 
-        Session.__init__(self, address = address)
+        if self.protocols == ("json", ) and not self.compression:
+            return JsonProtocol()
+
+        self.socket.sendall(hello(self.protocols, self.compression))
+
+        line = self.sockfile.readline()
+        if not line:
+            raise socket.error("Connection closed during handshake")
+
+        reply = JsonProtocol().decode(line)
+
+        if isinstance(reply, dict) and "retry-after" in reply:
+            raise RetryLater(reply["retry-after"])
+
+        try:
+            protocol = protocols[reply["protocol"]]()
+        except (KeyError, TypeError):
+            raise ProtocolError("Invalid handshake reply: {}".format(reply))
+
+        compression = reply.get("compression")
+        if compression is not None:
+            if compression not in self.compression:
+                raise ProtocolError("Unexpected compression: {}"
+                                    .format(compression))
+
+            self._compress(compression)
+
+        return protocol
 
     def connect(self):
         """Connect to a server"""
@@ -272,21 +662,261 @@ class Client(Session):
         # Reset `cleanExit`
         self.cleanExit = False
 
-        # Keep retrying the connection
+        # Keep retrying the connection, starting with the primary
+        index = 0
+
         while True:
+            self.address = self.addresses[index]
+            self.log = logger.name("session") \
+                             .fields(host = self.address[0],
+                                     port = self.address[1])
+
             try:
-                self.socket = create_connection(self.address, 2)
+                self.socket     = None
+                self.compressor = None
+                self.socket     = create_connection(self.address, 2)
+                self.sockfile   = self.socket.makefile()
+                self.protocol   = self._handshake()
+
+                # The timeout is only meant for connecting/the handshake,
+                # the recv loop waits on an idle socket
+                self.socket.settimeout(None)
                 break
-            except socket.error as e:
-                self.log.debug("Connect failed ({}), retrying in {} seconds",
-                    e, self.retryInterval
+            except (socket.error, ProtocolError, RetryLater) as e:
+                if self.socket:
+                    self.socket.close()
+
+                if isinstance(e, RetryLater):
+                    self.retryAfter = max(e.delay, self.retryAfter or 0)
+
+                # Fail over right away, wait once everything failed
+                index = (index + 1) % len(self.addresses)
+                if index:
+                    self.log.debug("Connect failed ({}), failing over", e)
+                    continue
+
+                delay = self.retryDelay()
+
+                self.log.debug("Connect failed ({}), retrying in {:.1f} seconds",
+                    e, delay
                 )
-                gevent.sleep(self.retryInterval)
+                gevent.sleep(delay)
+
+        self.backoff.reset()
+
+        if index and self.failbackInterval:
+            gevent.spawn(self._failbackLoop, self.socket)
+
+        if self.connectHandler:
+            self.connectHandler()
 
         self.start()
 
+    def retryDelay(self):
+        """
+        Get the delay before the next connection attempt
+
+        :returns: Delay in seconds
+        """
+
+        delay = self.backoff.delay()
+
+        if self.retryAfter is not None:
+            delay += self.retryAfter
+            self.retryAfter = None
+
+        return delay
+
+    def _failbackLoop(self, connection):
+        """
+        Move back to the primary once it's reachable again
+
+        :connection: Socket connected to the failover, stops when the
+                     client isn't using it anymore
+        """
+
+        while True:
+            gevent.sleep(self.failbackInterval)
+
+            if self.socket is not connection:
+                return
+
+            try:
+                create_connection(self.addresses[0], 2).close()
+            except socket.error:
+                continue
+
+            if self.socket is not connection:
+                return
+
+            self.log.info("Primary {}:{} is back, failing back",
+                          *self.addresses[0])
+
+            # Ends the recv loop, which reconnects starting at the primary
+            self.cleanExit = True
+            connection.shutdown(socket.SHUT_RDWR)
+            return
+
+    def _recvPacket(self, packet):
+        """Modified `_recvPacket` to pick up a retry-after hint"""
+
+        # Clients that don't handshake get turned away with a plain packet
+        if isinstance(packet, dict) and "retry-after" in packet:
+            self.retryAfter = packet["retry-after"]
+            return
+
+        Session._recvPacket(self, packet)
+
     def _recvLoop(self):
         """Modified `_recvLoop` to implement automatic reconnecting"""
 
         Session._recvLoop(self)
+
+        # Not closed yet if the connection was lost or shut down
+        self.socket.close()
+
+        if self.disconnectHandler:
+            self.disconnectHandler()
+
+        # Clients that lost the same server shouldn't all be back at once
+        gevent.sleep(self.retryDelay())
         self.connect()
+
+class DatagramServer(object):
+    """
+    Accepts self-contained JSON (batch) packets over UDP, one per datagram.
+
+    There's no per reporter state at all, at the price of packets getting
+    lost without anyone noticing.
+    """
+
+    # Method to call when a packet arrives
+    # if None don't call
+    packetHandler = None
+
+    def __init__(self, port, maxSize = 8192, reusePort = False):
+        """
+        :port:      Port to listen on
+        :maxSize:   Largest datagram accepted, bigger ones count as truncated
+        :reusePort: Bind with SO_REUSEPORT
+        """
+
+        self.port      = port
+        self.maxSize   = maxSize
+        self.reusePort = reusePort
+
+        self.protocol = JsonProtocol()
+        self.socket   = None
+        self.greenlet = None
+
+        self.received  = 0
+        self.truncated = 0
+        self.malformed = 0
+
+        self.log = logger.name("datagram-server").fields(port = port)
+
+    def listen(self):
+        """Start listening"""
+
+        self.socket   = bind(self.port, socket.SOCK_DGRAM, self.reusePort)
+        self.greenlet = gevent.spawn(self._recvLoop)
+
+        self.log.info("Started listening on UDP port {}", self.port)
+
+    def _recvLoop(self):
+        """Loop for receiving datagrams"""
+
+        while True:
+            # One byte extra to tell apart a full and a truncated datagram
+            datagram, address = self.socket.recvfrom(self.maxSize + 1)
+
+            if len(datagram) > self.maxSize:
+                self.truncated += 1
+                self.log.debug("Truncated datagram from {}", address[0])
+                continue
+
+            try:
+                packet = self.protocol.decode(datagram)
+
+                if self.packetHandler:
+                    self.packetHandler(packet)
+            except (ProtocolError, KeyError, TypeError, AttributeError) as e:
+                self.malformed += 1
+                self.log.debug("Malformed datagram from {}: {}", address[0], e)
+                continue
+
+            self.received += 1
+
+class DatagramClient(object):
+    """
+    Fire-and-forget counterpart of `Client` sending every packet as a UDP
+    datagram. Sending never blocks and there's nothing to reconnect,
+    packets that can't be sent right away are dropped.
+    """
+
+    # Method to call after `connect`
+    # if None don't call
+    connectHandler = None
+
+    def __init__(self, address, maxSize = 8192):
+        """
+        :address: (host, port) tuple to send to
+        :maxSize: Largest datagram to send, bigger packets are dropped
+        """
+
+        self.address = address
+        self.maxSize = maxSize
+
+        self.protocol = JsonProtocol()
+        self.socket   = None
+        self.target   = None
+        self.finished = Event()
+
+        self.sent      = 0
+        self.dropped   = 0
+        self.oversized = 0
+
+        self.log = logger.name("datagram-client") \
+                         .fields(host = address[0], port = address[1])
+
+    def connect(self):
+        """Create the socket, nothing is actually connected"""
+
+        # Resolve once instead of for every datagram
+        self.target = (socket.gethostbyname(self.address[0]), self.address[1])
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+        if self.connectHandler:
+            self.connectHandler()
+
+    def send(self, packet):
+        """
+        Send a packet right away, dropping it if that's not possible
+
+        :packet: Packet to send
+        """
+
+        datagram = self.protocol.encode(packet)
+
+        if len(datagram) > self.maxSize:
+            self.oversized += 1
+            self.log.warning("Dropping {} byte packet, lower batchSize",
+                             len(datagram))
+            return
+
+        try:
+            self.socket.sendto(datagram, self.target)
+        except socket.error as e:
+            self.dropped += 1
+            self.log.debug("Dropping packet: {}", e)
+            return
+
+        self.sent += 1
+
+    def disconnect(self):
+        """Close the socket"""
+
+        self.socket.close()
+        self.finished.set()
@@ -0,0 +1,536 @@
+import struct
+import zlib
+
+import ujson
+
+class ProtocolError(Exception):
+    """
+    Exception thrown when a packet can't be encoded or decoded
+    """
+
+    pass
+
+class JsonProtocol(object):
+    """
+    Newline delimited JSON, the original protocol and the fallback for
+    reporters that don't negotiate anything.
+    """
+
+    name = "json"
+
+    def encode(self, packet):
+        """
+        Encode `packet` for sending
+
+        :packet: Packet to encode
+        :returns: String to write to the socket
+        """
+
+        return "{}\n".format(ujson.dumps(packet))
+
+    def decode(self, line):
+        """
+        Decode a single line
+
+        :line: Line to decode, a trailing newline is ignored
+        :returns: Decoded packet
+        """
+
+        try:
+            return ujson.loads(line)
+        except ValueError as e:
+            raise ProtocolError("Invalid JSON packet: {}".format(e))
+
+    def readFrame(self, sockfile):
+        """
+        Read the next undecoded packet from `sockfile`
+
+        :sockfile: File object to read from
+        :returns: Line to pass to `decode`, None if the connection was closed
+        """
+
+        line = sockfile.readline()
+        if not line:
+            return None
+
+        return line
+
+    def read(self, sockfile):
+        """
+        Read the next packet from `sockfile`
+
+        :sockfile: File object to read from
+        :returns: Decoded packet, None if the connection was closed
+        """
+
+        line = self.readFrame(sockfile)
+        if line is None:
+            return None
+
+        return self.decode(line)
+
+class BinaryProtocol(object):
+    """
+    Length prefixed binary frames, names are interned into small integer
+    ids once per session and values are packed as fixed width numbers.
+
+    Frame:  uint32 length, followed by `length` bytes of records
+    Record: 'S' uint16 id, uint16 length, utf-8 name  (define a name)
+            'P' uint32 timestamp, uint16 host id, uint16 entry count,
+                entries                               (packet)
+    Entry:  uint16 module id, uint8 flags, uint16 field count, a type per
+            field, a uint16 key id per field, the fixed width values,
+            the bytes of the string values
+
+    Entry flags: 1 = delta, only the changed keys are in the entry.
+
+    Value types are 'd' (double), 'q' (int64), 't'/'f' (bool), 'n' (None)
+    and 's' (uint16 length in the fixed width values, utf-8 string).
+
+    Everything between the types and the strings of an entry is packed
+    with a single `struct.Struct` compiled per type string, see `layout`.
+
+    Both directions keep their own name table, so a new instance has to be
+    used for every connection.
+    """
+
+    name = "binary"
+
+    # Id used for "no host"
+    NO_HOST = 0xFFFF
+
+    # Entry flags
+    DELTA = 0x01
+
+    # Largest frame we accept
+    maxFrameSize = 16 * 1024 * 1024
+
+    frameHeader  = struct.Struct("!I")
+    nameHeader   = struct.Struct("!cHH")
+    packetHeader = struct.Struct("!cIHH")
+    entryHeader  = struct.Struct("!HBH")
+
+    # Type string -> (Struct, whether all values are numbers), shared by
+    # all sessions
+    layouts    = {}
+    maxLayouts = 4096
+
+    def __init__(self):
+        # Name -> id for names we sent, id -> name for names we received
+        self.sendNames = {}
+        self.recvNames = []
+
+    def _intern(self, name, records, names):
+        """
+        Get the id for `name`, appending a definition record to `records`
+        if it wasn't sent before. New names go into `names`, the names of
+        the frame being built, and only become known to the peer once the
+        frame is sent.
+        """
+
+        nameId = self.sendNames.get(name)
+        if nameId is None:
+            nameId = names.get(name)
+        if nameId is not None:
+            return nameId
+
+        nameId = len(self.sendNames) + len(names)
+        if nameId >= self.NO_HOST:
+            raise ProtocolError("Name table full")
+
+        encoded = name.encode("utf-8")
+        if len(encoded) > 0xFFFF:
+            raise ProtocolError("Name too long ({} bytes)".format(len(encoded)))
+
+        records.append(self.nameHeader.pack("S", nameId, len(encoded)))
+        records.append(encoded)
+
+        names[name] = nameId
+        return nameId
+
+    @classmethod
+    def layout(cls, kinds):
+        """
+        Get the struct for the key ids and fixed width values of an entry
+        with value types `kinds`
+
+        :returns: (Struct, True if all values are numbers)
+        """
+
+        layout = cls.layouts.get(kinds)
+        if layout is not None:
+            return layout
+
+        if kinds.translate(None, "dqstfn"):
+            raise ProtocolError("Unknown value types in {!r}".format(kinds))
+
+        if len(cls.layouts) >= cls.maxLayouts:
+            cls.layouts.clear()
+
+        values = kinds.translate(None, "tfn").replace("s", "H")
+        layout = cls.layouts[kinds] = (
+            struct.Struct("!" + "H" * len(kinds) + values),
+            not kinds.translate(None, "dq")
+        )
+
+        return layout
+
+    def encode(self, packet):
+        """
+        Encode `packet` (a regular or a batch packet) into a frame
+
+        :packet: Packet to encode
+        :returns: String to write to the socket
+        """
+
+        entries = packet["batch"] if "batch" in packet else (packet, )
+
+        if len(entries) > 0xFFFF:
+            raise ProtocolError("Too many entries ({})".format(len(entries)))
+
+        records = []
+        body    = []
+        names   = {}
+
+        try:
+            host   = packet.get("host")
+            hostId = self.NO_HOST if host is None \
+                                  else self._intern(host, records, names)
+
+            body.append(self.packetHeader.pack("P", packet.get("timestamp", 0),
+                                               hostId, len(entries)))
+
+            for entry in entries:
+                data = entry["data"]
+
+                if len(data) > 0xFFFF:
+                    raise ProtocolError("Too many fields ({})".format(len(data)))
+
+                flags = self.DELTA if entry.get("delta") else 0
+
+                body.append(self.entryHeader.pack(
+                    self._intern(entry["module"], records, names), flags,
+                    len(data)
+                ))
+
+                kinds   = []
+                ids     = []
+                values  = []
+                strings = []
+
+                for key, value in data.iteritems():
+                    ids.append(self._intern(key, records, names))
+
+                    if type(value) is float:
+                        kinds.append("d")
+                        values.append(value)
+                    elif value is None:
+                        kinds.append("n")
+                    elif value is True:
+                        kinds.append("t")
+                    elif value is False:
+                        kinds.append("f")
+                    elif isinstance(value, (int, long)) and \
+                         -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+                        kinds.append("q")
+                        values.append(value)
+                    elif isinstance(value, (int, long, float)):
+                        kinds.append("d")
+                        values.append(value)
+                    elif isinstance(value, basestring):
+                        encoded = value.encode("utf-8")
+                        if len(encoded) > 0xFFFF:
+                            raise ProtocolError("String too long ({} bytes)"
+                                                .format(len(encoded)))
+
+                        kinds.append("s")
+                        values.append(len(encoded))
+                        strings.append(encoded)
+                    else:
+                        raise ProtocolError("Can't encode value {!r}"
+                                            .format(value))
+
+                kinds = "".join(kinds)
+
+                body.append(kinds)
+                body.append(self.layout(kinds)[0].pack(*(ids + values)))
+                body.extend(strings)
+        except (struct.error, AttributeError, KeyError, TypeError) as e:
+            raise ProtocolError("Can't encode packet: {}".format(e))
+
+        frame = "".join(records + body)
+        if len(frame) > self.maxFrameSize:
+            raise ProtocolError("Frame too large ({} bytes)".format(len(frame)))
+
+        # Complete, the peer will know these names once it's sent
+        self.sendNames.update(names)
+
+        return self.frameHeader.pack(len(frame)) + frame
+
+    def _name(self, nameId):
+        try:
+            return self.recvNames[nameId]
+        except IndexError:
+            raise ProtocolError("Unknown name id {}".format(nameId))
+
+    def decode(self, frame):
+        """
+        Decode the body of a frame
+
+        :frame: Frame without the length prefix
+        :returns: Decoded packet, regular if it has a single entry
+        """
+
+        offset = 0
+
+        try:
+            # Name definitions come first
+            while frame[offset] == "S":
+                _, nameId, size = self.nameHeader.unpack_from(frame, offset)
+                offset += self.nameHeader.size
+
+                if nameId != len(self.recvNames):
+                    raise ProtocolError("Out of order name id {}".format(nameId))
+
+                self.recvNames.append(frame[offset:offset + size].decode("utf-8"))
+                offset += size
+
+            kind, timestamp, hostId, count = \
+                self.packetHeader.unpack_from(frame, offset)
+            offset += self.packetHeader.size
+
+            if kind != "P":
+                raise ProtocolError("Unknown record type {!r}".format(kind))
+
+            names   = self.recvNames
+            entries = []
+
+            for _ in xrange(count):
+                moduleId, flags, fields = \
+                    self.entryHeader.unpack_from(frame, offset)
+                offset += self.entryHeader.size
+
+                kinds   = frame[offset:offset + fields]
+                offset += fields
+
+                if len(kinds) != fields:
+                    raise ProtocolError("Truncated entry")
+
+                layout, numeric = self.layout(kinds)
+
+                values  = layout.unpack_from(frame, offset)
+                offset += layout.size
+
+                try:
+                    keys = map(names.__getitem__, values[:fields])
+                except IndexError:
+                    raise ProtocolError("Unknown name id in entry")
+
+                if numeric:
+                    data = dict(zip(keys, values[fields:]))
+                else:
+                    data     = {}
+                    position = fields
+
+                    for key, kind in zip(keys, kinds):
+                        if kind == "t":
+                            data[key] = True
+                        elif kind == "f":
+                            data[key] = False
+                        elif kind == "n":
+                            data[key] = None
+                        elif kind == "s":
+                            size      = values[position]
+                            data[key] = frame[offset:offset + size] \
+                                            .decode("utf-8")
+                            offset   += size
+                            position += 1
+                        else:
+                            data[key] = values[position]
+                            position += 1
+
+                entry = {"module": self._name(moduleId), "data": data}
+                if flags & self.DELTA:
+                    entry["delta"] = True
+
+                entries.append(entry)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ProtocolError("Malformed frame: {}".format(e))
+
+        if len(entries) == 1:
+            packet = entries[0]
+        else:
+            packet = {"batch": entries}
+
+        packet["timestamp"] = timestamp
+        if hostId != self.NO_HOST:
+            packet["host"] = self._name(hostId)
+
+        return packet
+
+    def readFrame(self, sockfile):
+        """
+        Read the next frame from `sockfile`
+
+        :sockfile: File object to read from
+        :returns: Frame to pass to `decode`, None if the connection was
+                  closed
+        """
+
+        header = sockfile.read(self.frameHeader.size)
+        if len(header) < self.frameHeader.size:
+            return None
+
+        size = self.frameHeader.unpack(header)[0]
+        if size > self.maxFrameSize:
+            raise ProtocolError("Frame too large ({} bytes)".format(size))
+
+        frame = sockfile.read(size)
+        if len(frame) < size:
+            return None
+
+        return frame
+
+    def read(self, sockfile):
+        """
+        Read and decode the next frame from `sockfile`
+
+        :sockfile: File object to read from
+        :returns: Decoded packet, None if the connection was closed
+        """
+
+        frame = self.readFrame(sockfile)
+        if frame is None:
+            return None
+
+        return self.decode(frame)
+
+class InflatingReader(object):
+    """
+    File-like reader over a socket carrying a compressed stream, with the
+    `read` and `readline` the protocols use.
+
+    Peers don't send anything after the handshake until they got an
+    answer, so nothing compressed is left in the buffer of the file used
+    for the handshake.
+    """
+
+    # Bytes to receive at once
+    chunkSize = 16384
+
+    # Most bytes to inflate at once, so a tiny compressed packet can't make
+    # us allocate gigabytes
+    inflateLimit = 1024 * 1024
+
+    def __init__(self, socket, decompressor):
+        """
+        :socket:       Socket to read from
+        :decompressor: Decompression object, e.g. `zlib.decompressobj()`
+        """
+
+        self.socket       = socket
+        self.decompressor = decompressor
+
+        # Inflated data, and where the unread part starts
+        self.buffer = ""
+        self.offset = 0
+
+        self.wireBytes = 0
+        self.rawBytes  = 0
+
+    def _fill(self):
+        """
+        Inflate more data into the buffer
+
+        :returns: False if the connection was closed
+        """
+
+        data = self.decompressor.unconsumed_tail
+        if not data:
+            data = self.socket.recv(self.chunkSize)
+            if not data:
+                return False
+
+            self.wireBytes += len(data)
+
+        try:
+            raw = self.decompressor.decompress(data, self.inflateLimit)
+        except zlib.error as e:
+            raise ProtocolError("Invalid compressed stream: {}".format(e))
+
+        self.rawBytes += len(raw)
+
+        # Drop what's been read before growing the buffer
+        self.buffer = self.buffer[self.offset:] + raw
+        self.offset = 0
+
+        return True
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            if not self._fill():
+                break
+
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+
+        return data
+
+    def readline(self):
+        index = self.buffer.find("\n", self.offset)
+
+        while index < 0:
+            searched = len(self.buffer) - self.offset
+
+            if not self._fill():
+                break
+
+            index = self.buffer.find("\n", self.offset + searched)
+
+        end  = index + 1 if index >= 0 else len(self.buffer)
+        line = self.buffer[self.offset:end]
+        self.offset = end
+
+        return line
+
+# Protocol name -> factory
+protocols = {
+    JsonProtocol.name  : JsonProtocol,
+    BinaryProtocol.name: BinaryProtocol,
+}
+
+# Stream compression name -> (compressor factory, decompressor factory),
+# the compressor is sync flushed after every batch of packets
+compressions = {
+    "zlib": (zlib.compressobj, zlib.decompressobj),
+}
+
+def hello(names, compression = ()):
+    """
+    Build the handshake a client sends to offer `names` protocols
+
+    :names:       Protocol names in order of preference
+    :compression: Stream compressions to offer, in order of preference
+    :returns: Line to write to the socket
+    """
+
+    offer = {"protocols": list(names)}
+    if compression:
+        offer["compression"] = list(compression)
+
+    return JsonProtocol().encode({"hello": offer})
+
+def negotiate(offered, supported):
+    """
+    Pick the protocol to use for a session
+
+    :offered:   Protocol names the client offered, in order of preference
+    :supported: Protocol names the server supports
+    :returns: Name of the chosen protocol, "json" if nothing matches
+    """
+
+    for name in offered:
+        if name in supported and name in protocols:
+            return name
+
+    return JsonProtocol.name
@@ -1,21 +1,25 @@
 from gevent import monkey; monkey.patch_time()
 
 import functools
+import gc
+import os
+import resource
 import socket
 import time
 import sys
 
 from datetime import datetime
 
-import ujson
 import gevent
 import psutil
 
-from network import Client
+from network import Client, DatagramClient
+from spool import RingFile, SendSpool
 
-from xstats.net import stream_network_throughput_rolling_avg, get_network_avg
+from xstats.net import calculate_rates, RollingStats
 
-from shared import parseConfig, loadModulesFromConfig, BasePublisher
+from shared import parseConfig, loadModulesFromConfig, BasePublisher, \
+                   Backoff, HashRing
 
 from twiggy import log; logger = log.name(__name__)
 
@@ -55,140 +59,586 @@ class Module(object):
     def publishMulti(self, data):
         self.publisher.publish(self.name, data)
 
-class BandwidthRollingAvgModule(Module):
+def calculate_cpu_percent(old_times, new_times):
+    """
+    Calculate the CPU utilization between two `psutil.cpu_times` snapshots,
+    the same way `psutil.cpu_percent` does.
+
+    :returns: Percentage of time the CPU was busy
+    """
+
+    old_total = sum(old_times)
+    new_total = sum(new_times)
+
+    total_delta = new_total - old_total
+    if total_delta <= 0:
+        return 0.0
+
+    busy_delta = (new_total - new_times.idle) - (old_total - old_times.idle)
+
+    return round(busy_delta / total_delta * 100, 1)
+
+class Sampler(object):
+    """
+    Takes a single snapshot of every psutil source per tick and hands it to
+    all subscribed `SampledModule` instances, so each source is only read
+    once per tick no matter how many modules use it.
+
+    The CPU time every subscriber (and the `tickHandler`, as "publish")
+    spends per tick is accounted, along with the number of objects it
+    allocated, see `costs`.
+    """
+
+    # Method to call after every tick, once all subscribers have sampled
+    # if None don't call
+    tickHandler = None
+
+    # Source name -> callable returning the snapshot for that source
+    sources = {
+        'network'       : lambda: psutil.network_io_counters(False),
+        'network-pernic': lambda: psutil.network_io_counters(True),
+        'cpu'           : lambda: psutil.cpu_times(False),
+        'cpu-percpu'    : lambda: psutil.cpu_times(True),
+        'memory'        : psutil.phymem_usage,
+        'swap'          : psutil.virtmem_usage,
+    }
+
+    def __init__(self, interval = 1):
+        """
+        Initialize the sampler
+
+        :interval: Seconds between ticks
+        """
+
+        self.interval    = interval
+        self.subscribers = []
+        self.active      = ()
+        self.greenlet    = None
+
+        # Subscriber -> unique name, and name -> [cpu seconds, objects
+        # allocated, calls] since the last `takeCosts`
+        self.labels = {}
+        self.costs  = {}
+
+        self.log = logger.name("sampler")
+
+    def subscribe(self, module):
+        """
+        Subscribe `module` to the sources listed in its `sources` attribute
+
+        :module: `SampledModule` to call every tick
+        """
+
+        unknown = set(module.sources) - set(self.sources)
+        if unknown:
+            raise ValueError("Unknown sample source(s) for {}: {}".format(
+                module.name, ", ".join(sorted(unknown))
+            ))
+
+        label  = module.name
+        suffix = 1
+        while label in self.labels.values():
+            suffix += 1
+            label = "{}-{}".format(module.name, suffix)
+
+        self.labels[module] = label
+        self.subscribers.append(module)
+
+    def account(self, label, started, objects):
+        """
+        Add a call to the costs of `label`
+
+        :started: `time.clock()` before the call
+        :objects: Allocation count (`gc.get_count()[0]`) before the call
+        """
+
+        cost = self.costs.get(label)
+        if cost is None:
+            cost = self.costs[label] = [0.0, 0, 0]
+
+        cost[0] += time.clock() - started
+
+        # Collections reset the count, those calls only count what's after
+        allocated = gc.get_count()[0] - objects
+        if allocated > 0:
+            cost[1] += allocated
+
+        cost[2] += 1
+
+    def takeCosts(self):
+        """
+        Get the costs accounted since the last call and start over
+
+        :returns: Dictionary of name -> [cpu seconds, objects, calls]
+        """
+
+        costs, self.costs = self.costs, {}
+        return costs
+
+    def start(self):
+        """Start ticking, if anything subscribed"""
+
+        if not self.subscribers:
+            return
+
+        # Subscriptions are fixed from here on, only sample what's used
+        active = set()
+        for module in self.subscribers:
+            active.update(module.sources)
+
+        self.active   = tuple(active)
+        self.greenlet = gevent.spawn(self.run)
+
+    def snapshot(self):
+        """
+        Read every active source once
+
+        :returns: Dictionary of source name -> snapshot
+        """
+
+        return dict((name, self.sources[name]()) for name in self.active)
+
+    def tick(self):
+        """Take a snapshot and hand it to all subscribers"""
+
+        timestamp = time.time()
+        snapshot  = self.snapshot()
+
+        for module in self.subscribers:
+            started = time.clock()
+            objects = gc.get_count()[0]
+
+            try:
+                module.sample(timestamp, snapshot)
+            except Exception as e:
+                self.log.trace('error').error("{} failed to sample: {}",
+                                              module.name, e)
+
+            self.account(self.labels[module], started, objects)
+
+        if self.tickHandler:
+            started = time.clock()
+            objects = gc.get_count()[0]
+
+            try:
+                self.tickHandler()
+            except Exception as e:
+                # Would stop the sampler, and with it all reporting
+                self.log.trace('error').error("Tick handler failed: {}", e)
+
+            self.account("publish", started, objects)
+
+    def run(self):
+        """Tick on a fixed schedule so the sampling windows don't drift"""
+
+        nextTick = time.time()
+
+        while True:
+            self.tick()
+
+            nextTick += self.interval
+            delay = nextTick - time.time()
+
+            # If we fell behind skip the missed ticks instead of bursting
+            if delay < 0:
+                nextTick = time.time()
+                delay    = 0
+
+            gevent.sleep(delay)
+
+class SampledModule(Module):
+    """
+    Base for modules that are driven by the shared `Sampler` instead of
+    running their own loop.
+    """
+
+    # Sampler sources this module wants every tick
+    sources = ()
+
+    def start(self):
+        """Nothing to spawn, the `Sampler` calls `sample` every tick"""
+        pass
+
+    def sample(self, timestamp, snapshot):
+        """
+        Called by the `Sampler` every tick
+
+        :timestamp: Time the snapshot was taken
+        :snapshot:  Dictionary of source name -> psutil result
+        """
+        pass
+
+class NetworkCounterModule(SampledModule):
+    """Base for modules calculating rates from the network counters"""
+
+    def __init__(self, interface = None):
+        """
+        :interface: Interface, combined if None, specific interface if string.
+        """
+
+        self.interface = interface
+        self.sources   = ('network-pernic', ) if interface else ('network', )
+
+        # (timestamp, counters) of the previous tick
+        self.lastSample = None
+
+        Module.__init__(self)
+
+    def rates(self, timestamp, snapshot, attributes):
+        """
+        Calculate the per second rate of `attributes` since the last tick
+
+        :returns: List of rates, or None on the first tick
+        """
+
+        counters = snapshot[self.sources[0]]
+        if self.interface:
+            counters = counters[self.interface]
+
+        lastSample      = self.lastSample
+        self.lastSample = (timestamp, counters)
+
+        if lastSample is None:
+            return None
+
+        return calculate_rates(lastSample[1], counters,
+                               timestamp - lastSample[0], attributes)
+
+class BandwidthRollingAvgModule(NetworkCounterModule):
     """Reports bandwidth rolling average."""
 
     name = "bandwidth-rolling"
 
-    def __init__(self, interface = None):
+    def __init__(self, interface = None, samples = 30, extended = False,
+                 alpha = 0.2):
         """
         Initialize BandwidthRollingAvgModule
 
         :interface: Interface, combined if None, specific interface if string.
+        :samples:   Number of samples to average over
+        :extended:  Also report the window min/max and the EWMA
+        :alpha:     Weight of a new sample in the EWMA
         """
 
-        self.interface = interface
+        self.extended = extended
+        self.stats    = RollingStats(('bytes_sent', 'bytes_recv'),
+                                     samples, alpha)
 
-        Module.__init__(self)
+        NetworkCounterModule.__init__(self, interface)
 
-    def run(self):
-        stream_network_throughput_rolling_avg(callback = self.callback,
-                                              interface = self.interface)
+    def sample(self, timestamp, snapshot):
+        rates = self.rates(timestamp, snapshot, self.stats.attributes)
+        if rates is None:
+            return
+
+        self.stats.update(rates)
+        self.callback(self.stats.averages())
 
     def callback(self, average):
         interface = "all" if not self.interface else self.interface
         keyName   = "average-{}".format(interface)
 
-        self.publishMulti({
+        publishData = {
             "{}-out".format(keyName): average[0],
             "{}-in".format(keyName): average[1],
-        })
+        }
 
-class NetworkModule(Module):
+        if self.extended:
+            for suffix, values in (("min",  self.stats.minimums()),
+                                   ("max",  self.stats.maximums()),
+                                   ("ewma", self.stats.ewma())):
+                publishData["{}-out-{}".format(keyName, suffix)] = values[0]
+                publishData["{}-in-{}".format(keyName, suffix)]  = values[1]
+
+        self.publishMulti(publishData)
+
+class NetworkModule(NetworkCounterModule):
     """Reports network statistics"""
 
     name = "network"
 
-    def __init__(self, interface = None):
-        """
-        Initialize NetworkModule
+    def sample(self, timestamp, snapshot):
+        averages = self.rates(timestamp, snapshot, ('bytes_sent', 'bytes_recv',
+                                                    'packets_sent',
+                                                    'packets_recv'))
+        if averages is None:
+            return
 
-        :interface: Interface, combined if None, specific interface if string.
+        self.publishMulti({
+            'bytes-sent': averages[0],
+            'bytes-recv': averages[1],
+            'packets-sent': averages[2],
+            'packets-recv': averages[3]
+        })
+
+class CpuModule(SampledModule):
+    name = "cpu"
+
+    def __init__(self, interval = 1.0, percpu = False):
+        """
+        :interval: Seconds to measure the load over
+        :percpu:   Report every CPU separately
         """
 
-        self.interface = interface
+        self.interval = interval
+        self.percpu   = percpu
+        self.sources  = ('cpu-percpu', ) if percpu else ('cpu', )
+
+        # (timestamp, cpu_times) at the start of the current measurement
+        self.lastSample = None
 
         Module.__init__(self)
 
-    def run(self):
-        interface = "all" if not self.interface else self.interface
-        keyName   = "average-{}".format(interface)
+    def sample(self, timestamp, snapshot):
+        cpuTimes = snapshot[self.sources[0]]
 
-        while True:
-            averages = get_network_avg(interface = self.interface)
+        if self.lastSample is None:
+            self.lastSample = (timestamp, cpuTimes)
+            return
 
-            self.publishMulti({
-                'bytes-sent': averages[0],
-                'bytes-recv': averages[1],
-                'packets-sent': averages[2],
-                'packets-recv': averages[3]
-            })
+        # Allow for a little scheduling jitter on the tick
+        if timestamp - self.lastSample[0] < self.interval * 0.9:
+            return
 
-class CpuModule(Module):
-    name = "cpu"
+        lastTimes       = self.lastSample[1]
+        self.lastSample = (timestamp, cpuTimes)
+
+        publishData = {}
+
+        if self.percpu:
+            cpuLoad = [calculate_cpu_percent(old, new)
+                            for old, new in zip(lastTimes, cpuTimes)]
+
+            publishData['num'] = len(cpuLoad)
+            for index in xrange(0, len(cpuLoad)):
+                publishData["cpu%u" % index] = cpuLoad[index]
+        else:
+            publishData['avg'] = calculate_cpu_percent(lastTimes, cpuTimes)
+
+        self.publishMulti(publishData)
+
+class MemoryModule(SampledModule):
+    name = "memory"
+
+    sources = ('memory', 'swap')
+
+    def sample(self, timestamp, snapshot):
+        physical = snapshot['memory']._asdict()
+        swap     = snapshot['swap']._asdict()
+
+        publishData = {}
+
+        for key, value in physical.iteritems():
+            publishData["physical-{}".format(key)] = value
+
+        for key, value in swap.iteritems():
+            publishData["swap-{}".format(key)] = value
+
+        self.publishMulti(publishData)
+
+class ReporterModule(SampledModule):
+    """
+    Reports the footprint of the reporter itself, the CPU use and RSS of
+    the process and per module (see `Sampler.costs`):
+
+    <module>-cpu:     CPU use in percent of a core
+    <module>-objects: Objects allocated per tick
+
+    Over UDP the datagram counters of the client are reported as well, as
+    udp-sent, udp-dropped and udp-oversized.
+    """
+
+    name = "reporter"
+
+    # `DatagramClient` whose counters to report, set by `start`
+    client = None
+
+    def __init__(self, interval = 10):
+        """
+        :interval: Seconds between reports
+        """
 
-    def __init__(self, interval = 1.0, percpu = False):
         self.interval = interval
-        self.percpu = percpu
+        self.process  = psutil.Process(os.getpid())
 
-    def run(self):
-        while True:
-            cpuLoad = psutil.cpu_percent(interval = self.interval,
-                                          percpu = self.percpu)
+        # (timestamp, cpu seconds) at the start of the current period
+        self.lastSample = None
 
-            publishData = {}
+        Module.__init__(self)
 
-            if self.percpu:
-                publishData['num'] = len(cpuLoad)
-                for index in xrange(0, len(cpuLoad)):
-                    publishData["cpu%u" % index] = cpuLoad[index]
-            else:
-                publishData['avg'] = cpuLoad
+    def cpuTime(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
 
-            self.publishMulti(publishData)
+    def sample(self, timestamp, snapshot):
+        sampler = self.publisher.sampler
 
-class MemoryModule(Module):
-    name = "memory"
+        if self.lastSample is None:
+            self.lastSample = (timestamp, self.cpuTime())
+            sampler.takeCosts()
+            return
 
-    def run(self):
-        while True:
-            physical = psutil.phymem_usage()._asdict()
-            swap     = psutil.virtmem_usage()._asdict()
+        if timestamp - self.lastSample[0] < self.interval * 0.9:
+            return
+
+        cpuTime = self.cpuTime()
+        elapsed = timestamp - self.lastSample[0]
+        lastCpu = self.lastSample[1]
+
+        self.lastSample = (timestamp, cpuTime)
 
-            publishData = {}
+        publishData = {
+            "cpu": round((cpuTime - lastCpu) / elapsed * 100, 2),
+            "rss": self.process.get_memory_info().rss,
+        }
 
-            for key, value in physical.iteritems():
-                publishData["physical-{}".format(key)] = value
+        for label, (cpu, objects, calls) in sampler.takeCosts().iteritems():
+            publishData["{}-cpu".format(label)] = \
+                round(cpu / elapsed * 100, 3)
+            publishData["{}-objects".format(label)] = objects / calls
 
-            for key, value in swap.iteritems():
-                publishData["swap-{}".format(key)] = value
+        if self.client is not None:
+            publishData["udp-sent"]      = self.client.sent
+            publishData["udp-dropped"]   = self.client.dropped
+            publishData["udp-oversized"] = self.client.oversized
 
-            self.publishMulti(publishData)
+        self.publishMulti(publishData)
 
-            gevent.sleep(1)
+class DeltaEncoder(object):
+    """
+    Strips the keys that didn't change since the last packet of a module,
+    a full keyframe is sent every `keyframeInterval` seconds and after
+    `reset` (e.g. when the connection drops).
+    """
+
+    def __init__(self, keyframeInterval = 30):
+        """
+        :keyframeInterval: Seconds between keyframes, 0 disables deltas
+        """
+
+        self.keyframeInterval = keyframeInterval
+
+        # Module name -> data as last sent, and time of its last keyframe
+        self.states    = {}
+        self.keyframes = {}
+
+    def reset(self):
+        """Forget all state, the next packet of every module is a keyframe"""
+
+        self.states    = {}
+        self.keyframes = {}
+
+    def encode(self, moduleName, data):
+        """
+        Encode `data` of `moduleName` into a batch entry
+
+        :returns: Entry dictionary, with "delta" set if only changes are in it
+        """
+
+        now   = time.time()
+        state = self.states.get(moduleName)
+
+        if not self.keyframeInterval or state is None or \
+           now - self.keyframes[moduleName] >= self.keyframeInterval:
+            self.states[moduleName]    = dict(data)
+            self.keyframes[moduleName] = now
+
+            return {"module": moduleName, "data": data}
+
+        changed = dict((key, value) for key, value in data.iteritems()
+                            if key not in state or state[key] != value)
+        state.update(changed)
+
+        return {"module": moduleName, "data": changed, "delta": True}
 
 class Publisher(BasePublisher):
-    def __init__(self, target):
-        self.target = target
+    """
+    Gathers the output of all modules into batches, a batch is handed to
+    `target` at the end of every `Sampler` tick, when it reaches
+    `batchSize` entries or after `batchTimeout` seconds, whichever is first.
+    """
+
+    def __init__(self, target, interval = 1, batchSize = 32,
+                 batchTimeout = 0.5, keyframeInterval = 30):
+        """
+        :target:           Callable to pass a list of batch entries to
+        :interval:         Seconds between `Sampler` ticks
+        :batchSize:        Maximum number of entries in a batch
+        :batchTimeout:     Maximum seconds an entry waits for its batch
+        :keyframeInterval: Seconds between full packets of a module, only
+                           changed keys are sent in between. 0 disables.
+        """
+
+        self.target       = target
+        self.batchSize    = batchSize
+        self.batchTimeout = batchTimeout
+        self.deltas       = DeltaEncoder(keyframeInterval)
+
+        self.batch      = []
+        self.flushTimer = None
+
+        self.sampler = Sampler(interval)
+        self.sampler.tickHandler = self.flush
 
         BasePublisher.__init__(self)
 
     def addModule(self, module):
         module.publisher = self
 
+        if isinstance(module, SampledModule):
+            self.sampler.subscribe(module)
+
         BasePublisher.addModule(self, module)
 
+    def start(self):
+        BasePublisher.start(self)
+        self.sampler.start()
+
     def publish(self, moduleName, data):
-        self.target(moduleName, data)
+        self.batch.append(self.deltas.encode(moduleName, data))
 
-def send_publish_socket(moduleName, packetData, client, additional = {}):
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+        elif self.flushTimer is None:
+            self.flushTimer = gevent.spawn_later(self.batchTimeout, self.flush)
+
+    def flush(self):
+        """Hand the current batch to `target`, if there's anything in it"""
+
+        if self.flushTimer is not None:
+            # Don't kill ourselves when called from the timer
+            if self.flushTimer is not gevent.getcurrent():
+                self.flushTimer.kill(block = False)
+            self.flushTimer = None
+
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        self.target(batch)
+
+def send_publish_batch(batch, client, additional = {}):
     """
-    Function that is used by the publisher to send its data.
+    Function that is used by the publisher to send a batch as a single
+    packet.
+
+    A batch of one is sent as a plain packet, so aggregators without batch
+    support keep working when `batchSize` is 1.
 
-    :packet_data: Data to send
-    :value:       Value to send
-    :client:      `Client` object to use to send the data
-    :additional:  additional key/value pairs to send along
+    :batch:      List of entries ({"module": ..., "data": ...})
+    :client:     `Client` object to use to send the data
+    :additional: additional key/value pairs to send along
     """
 
-    packet = {
-        "module"   : moduleName,
-        "data"     : packetData,
-        "timestamp": utc_unix_timestamp()
-    }
+    if len(batch) == 1:
+        packet = batch[0].copy()
+    else:
+        packet = {"batch": batch}
+
+    packet["timestamp"] = utc_unix_timestamp()
 
     packet.update(additional)
-    client.send(ujson.dumps(packet))
+    client.send(packet)
 
 def moduleFinder(name):
     moduleName = "{}Module".format(name)
@@ -196,6 +646,31 @@ def moduleFinder(name):
     moduleClass = getattr(sys.modules[__name__], moduleName)
     return moduleClass
 
+def aggregatorAddresses(config):
+    """
+    Get the aggregators to connect to in order of preference. With a list
+    of `aggregators` the primary is picked by consistent hashing on the
+    hostname, followed by the failovers in ring order.
+
+    :config: Reporter config
+    :returns: List of (host, port) tuples
+    """
+
+    if not config["aggregators"]:
+        return [(config["host"], config["port"])]
+
+    # "host" or "host:port" -> (host, port)
+    nodes = {}
+    for aggregator in config["aggregators"]:
+        host, _, port = str(aggregator).partition(":")
+        port = int(port) if port else config["port"]
+
+        nodes["{}:{}".format(host, port)] = (host, port)
+
+    ring = HashRing(sorted(nodes))
+
+    return [nodes[node] for node in ring.preference(config["hostname"])]
+
 def start(args):
     """
     Starts the reporter
@@ -206,10 +681,25 @@ def start(args):
 
     # Modules will be completely overwritten but that's as intended
     defaults = {
-        'hostname': socket.gethostname(),
-        'host'    : '127.0.0.1',
-        'port'    : 13337,
-        'modules' : {
+        'hostname'        : socket.gethostname(),
+        'host'            : '127.0.0.1',
+        'port'            : 13337,
+        'aggregators'     : None,
+        'failbackInterval': 60,
+        'interval'        : 1,
+        'batchSize'       : 32,
+        'batchTimeout'    : 0.5,
+        'keyframeInterval': 30,
+        'protocols'       : ['json'],
+        'compression'     : [],
+        'transport'       : 'tcp',
+        'spoolMemory'     : 1000,
+        'spoolPath'       : None,
+        'spoolSize'       : 64 * 1024 * 1024,
+        'replayRate'      : 500,
+        'retryInitial'    : 1,
+        'retryMax'        : 60,
+        'modules'         : {
             'Network': [
                 {}
             ]
@@ -226,23 +716,61 @@ def start(args):
         config["port"] = args.port
     if args.host:
         config["host"] = args.host
+        config["aggregators"] = None
     if args.hostname:
         config['hostname'] = args.hostname
 
+    addresses = aggregatorAddresses(config)
+
     # Initialize networking client
-    client = Client((config["host"], config["port"]))
+    if config["transport"] == "udp":
+        # Nothing tells us it's unreachable, so no failover
+        client = DatagramClient(addresses[0])
+
+        # Datagrams get lost, a lost delta would go unnoticed
+        config["keyframeInterval"] = 0
+    else:
+        ring = None
+        if config["spoolPath"]:
+            ring = RingFile(config["spoolPath"], config["spoolSize"])
+
+        spool   = SendSpool(config["spoolMemory"], ring)
+        backoff = Backoff(config["retryInitial"], config["retryMax"],
+                          jitter = True)
+
+        client = Client(addresses, config["protocols"], spool,
+                        config["replayRate"], backoff,
+                        config["failbackInterval"], config["compression"])
 
     # Create target function
-    target = functools.partial(send_publish_socket, additional = {
+    target = functools.partial(send_publish_batch, additional = {
         "host": config['hostname']
     }, client = client)
 
     # Initialize the publisher
-    publisher = Publisher(target)
+    publisher = Publisher(target, config['interval'],
+                          config['batchSize'], config['batchTimeout'],
+                          config['keyframeInterval'])
+
+    # Send keyframes after every reconnect
+    client.connectHandler = publisher.deltas.reset
+
+    if config["transport"] != "udp":
+        # What's queued while disconnected may be replayed to an aggregator
+        # that lost (or never had) our state, and a lost packet takes the
+        # changes in it along. Start over with keyframes in both cases.
+        client.disconnectHandler = publisher.deltas.reset
+        spool.dropHandler        = publisher.deltas.reset
 
     # Load modules
     loadModulesFromConfig(config, publisher, moduleFinder)
 
+    # Datagrams get lost without a trace otherwise
+    if isinstance(client, DatagramClient):
+        for module in publisher.modules:
+            if isinstance(module, ReporterModule):
+                module.client = client
+
     # Start client and publisher
     client.connect()
     publisher.start()
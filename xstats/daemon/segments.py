@@ -0,0 +1,402 @@
+"""
+Column oriented storage on disk, partitioned by time.
+
+A partition is a directory named after its start timestamp, holding
+segment files that are only ever written whole. A segment stores a column
+per (host, module, key) as little endian float64 values followed by uint32
+timestamps, sorted by timestamp, with a JSON index at the end:
+
+    "XSEG" version (uint32)
+    column data, each padded to 8 bytes
+    index: {"columns": [[host, module, key, offset, count, first, last],
+                        ...],
+            "replaces": [segment name, ...]}
+    index offset (uint64) index length (uint32) "XSEG"
+
+Segments are read through mmap, as NumPy arrays without copying when NumPy
+is installed and as `array.array`s otherwise.
+"""
+
+import array
+import bisect
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+import ujson
+
+from shared import inThread
+from tsdb import downsample
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from twiggy import log; logger = log.name(__name__)
+
+MAGIC   = "XSEG"
+VERSION = 1
+
+header = struct.Struct("<4sI")
+footer = struct.Struct("<QI4s")
+
+def column(timestamps, values):
+    """
+    Make a column of `timestamps` and `values`, sorted by timestamp
+
+    :returns: (timestamps, values) as arrays
+    """
+
+    if numpy is not None:
+        timestamps = numpy.asarray(timestamps, dtype = numpy.uint32)
+        values     = numpy.asarray(values, dtype = numpy.float64)
+
+        if (timestamps[1:] < timestamps[:-1]).any():
+            order = numpy.argsort(timestamps, kind = "mergesort")
+            timestamps, values = timestamps[order], values[order]
+
+        return timestamps, values
+
+    if any(a > b for a, b in zip(timestamps, timestamps[1:])):
+        points = sorted(zip(timestamps, values), key = lambda point: point[0])
+        timestamps = [timestamp for timestamp, _ in points]
+        values     = [value for _, value in points]
+
+    return array.array('I', timestamps), array.array('d', values)
+
+def between(timestamps, values, start = None, end = None):
+    """Slice a column to the points between `start` and `end`, inclusive"""
+
+    if numpy is not None:
+        low  = 0 if start is None else timestamps.searchsorted(start, "left")
+        high = len(timestamps) if end is None \
+                               else timestamps.searchsorted(end, "right")
+    else:
+        low  = 0 if start is None else bisect.bisect_left(timestamps, start)
+        high = len(timestamps) if end is None \
+                               else bisect.bisect_right(timestamps, end)
+
+    return timestamps[low:high], values[low:high]
+
+def merge(columns):
+    """
+    Merge columns into one, sorted by timestamp
+
+    :columns: List of (timestamps, values), each sorted
+    """
+
+    columns = [pair for pair in columns if len(pair[0])]
+
+    if not columns:
+        return column([], [])
+    if len(columns) == 1:
+        return columns[0]
+
+    if numpy is not None:
+        return column(numpy.concatenate([pair[0] for pair in columns]),
+                      numpy.concatenate([pair[1] for pair in columns]))
+
+    timestamps = []
+    values     = []
+
+    for pair in columns:
+        timestamps.extend(pair[0])
+        values.extend(pair[1])
+
+    return column(timestamps, values)
+
+def aggregate(timestamps, values, step, function = "avg"):
+    """
+    Aggregate a column into `step` second buckets
+
+    :function: One of avg, min, max, sum, count, last
+    :returns: List of (bucket start, aggregated value)
+    """
+
+    if numpy is None:
+        return downsample(zip(timestamps, values), step, function)
+
+    if not len(timestamps):
+        return []
+
+    buckets = timestamps - timestamps % step
+    starts  = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+    counts  = numpy.diff(numpy.append(starts, len(values)))
+
+    functions = {
+        "avg"  : lambda: numpy.add.reduceat(values, starts) / counts,
+        "min"  : lambda: numpy.minimum.reduceat(values, starts),
+        "max"  : lambda: numpy.maximum.reduceat(values, starts),
+        "sum"  : lambda: numpy.add.reduceat(values, starts),
+        "count": lambda: counts,
+        "last" : lambda: values[starts + counts - 1],
+    }
+
+    return zip(buckets[starts].tolist(), functions[function]().tolist())
+
+def toBytes(values, typecode):
+    """Little endian bytes of `values`, 'd' for float64 and 'I' for uint32"""
+
+    if numpy is not None:
+        dtype = "<f8" if typecode == "d" else "<u4"
+        return numpy.asarray(values).astype(dtype).tostring()
+
+    values = array.array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+
+    return values.tostring()
+
+def writeSegment(path, columns, replaces = ()):
+    """
+    Write a segment, atomically
+
+    :columns:  Iterable of ((host, module, key), timestamps, values), each
+               column sorted by timestamp
+    :replaces: Names of the segments this one replaces, removed when
+               loading the partition in case they outlive a compaction
+    :returns: Number of columns written
+    """
+
+    index  = []
+    offset = header.size
+
+    with open(path + ".tmp", "wb") as output:
+        output.write(header.pack(MAGIC, VERSION))
+
+        for key, timestamps, values in columns:
+            count = len(timestamps)
+            if not count:
+                continue
+
+            padding = -(count * 12) % 8
+
+            output.write(toBytes(values, "d"))
+            output.write(toBytes(timestamps, "I"))
+            output.write("\0" * padding)
+
+            index.append(list(key) + [offset, count, int(timestamps[0]),
+                                      int(timestamps[-1])])
+            offset += count * 12 + padding
+
+        data = ujson.dumps({"columns": index, "replaces": list(replaces)})
+
+        output.write(data)
+        output.write(footer.pack(offset, len(data), MAGIC))
+
+        output.flush()
+        os.fsync(output.fileno())
+
+    os.rename(path + ".tmp", path)
+
+    return len(index)
+
+class Segment(object):
+    """Read only, memory mapped segment file"""
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as segment:
+            self.map = mmap.mmap(segment.fileno(), 0, access = mmap.ACCESS_READ)
+
+        offset, length, magic = footer.unpack_from(self.map,
+                                                   len(self.map) - footer.size)
+        if magic != MAGIC or header.unpack_from(self.map)[0] != MAGIC:
+            raise ValueError("{} is not a segment".format(path))
+
+        index = ujson.loads(self.map[offset:offset + length])
+
+        # (host, module, key) -> (offset, count, first, last)
+        self.columns = dict(
+            ((host, module, key), (start, count, first, last))
+                for host, module, key, start, count, first, last
+                    in index["columns"]
+        )
+        self.replaces = index["replaces"]
+
+    def read(self, key, start = None, end = None):
+        """
+        Get the points of a column between `start` and `end`, inclusive
+
+        :returns: (timestamps, values), None if this segment doesn't have
+                  the column or any points in the range
+        """
+
+        entry = self.columns.get(key)
+        if entry is None:
+            return None
+
+        offset, count, first, last = entry
+
+        if (start is not None and last < start) or \
+           (end is not None and first > end):
+            return None
+
+        if numpy is not None:
+            # Views into the map, no copies
+            values     = numpy.frombuffer(self.map, "<f8", count, offset)
+            timestamps = numpy.frombuffer(self.map, "<u4", count,
+                                          offset + count * 8)
+        else:
+            values     = array.array('d', self.map[offset:offset + count * 8])
+            timestamps = array.array('I', self.map[offset + count * 8:
+                                                   offset + count * 12])
+
+            if sys.byteorder == "big":
+                values.byteswap()
+                timestamps.byteswap()
+
+        return between(timestamps, values, start, end)
+
+class Partition(object):
+    """
+    Directory of the segments of a time range. Segments are only added and
+    removed whole, the mmaps of removed segments stay valid until they're
+    no longer referenced so reads never see a segment disappear.
+    """
+
+    def __init__(self, path, start, duration):
+        """
+        :path:     Directory
+        :start:    First timestamp of the partition
+        :duration: Seconds the partition covers
+        """
+
+        self.path     = path
+        self.start    = start
+        self.end      = start + duration - 1
+        self.segments = []
+
+        self.log = logger.name("partition").fields(path = path)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        names    = sorted(os.listdir(path))
+        replaced = set()
+
+        for name in names:
+            if name.endswith(".tmp"):
+                # Write interrupted
+                os.unlink(os.path.join(path, name))
+            elif name.endswith(".seg"):
+                try:
+                    segment = Segment(os.path.join(path, name))
+                except (ValueError, EnvironmentError, struct.error) as e:
+                    self.log.warning("Skipping broken segment {}: {}", name, e)
+                    continue
+
+                self.segments.append(segment)
+                replaced.update(segment.replaces)
+
+        # Left over from an interrupted compaction
+        for segment in [s for s in self.segments
+                            if os.path.basename(s.path) in replaced]:
+            self.log.info("Removing compacted segment {}", segment.path)
+            self.segments.remove(segment)
+            os.unlink(segment.path)
+
+        self.sequence = max([self._sequence(s) for s in self.segments] or [0])
+
+    def _sequence(self, segment):
+        return int(os.path.basename(segment.path).split(".")[0])
+
+    def _nextPath(self):
+        self.sequence += 1
+        return os.path.join(self.path, "{:08d}.seg".format(self.sequence))
+
+    def _writeSegment(self, path, columns, replaces = ()):
+        """
+        Write and open a segment, runs in a thread
+
+        :returns: `Segment`, None if there was nothing to write
+        """
+
+        if writeSegment(path, columns, replaces):
+            return Segment(path)
+
+        os.unlink(path)
+        return None
+
+    def write(self, columns):
+        """
+        Add a segment, written in a thread
+
+        :columns: See `writeSegment`
+        """
+
+        segment = inThread(self._writeSegment, self._nextPath(), columns)
+
+        # The segment list is only changed from greenlets
+        if segment is not None:
+            self.segments.append(segment)
+
+    def read(self, key, start = None, end = None):
+        """
+        Get the points of a column between `start` and `end`
+
+        :returns: List of (timestamps, values), one per segment
+        """
+
+        columns = []
+
+        for segment in self.segments:
+            pair = segment.read(key, start, end)
+            if pair is not None:
+                columns.append(pair)
+
+        return columns
+
+    def keys(self):
+        keys = set()
+
+        for segment in self.segments:
+            keys.update(segment.columns)
+
+        return keys
+
+    def compact(self):
+        """
+        Merge all segments into one, in a thread
+
+        :returns: Number of segments merged
+        """
+
+        segments = list(self.segments)
+        if len(segments) < 2:
+            return 0
+
+        keys = set()
+        for segment in segments:
+            keys.update(segment.columns)
+
+        def columns():
+            for key in sorted(keys):
+                timestamps, values = merge(
+                    [pair for pair in (s.read(key) for s in segments)
+                              if pair is not None]
+                )
+                yield key, timestamps, values
+
+        # Segments are immutable, reading them in the thread is fine
+        merged = inThread(self._writeSegment, self._nextPath(), columns(),
+                          [os.path.basename(s.path) for s in segments])
+
+        # Segments flushed meanwhile stay
+        self.segments = [merged] + \
+                        [s for s in self.segments if s not in segments]
+
+        for segment in segments:
+            os.unlink(segment.path)
+
+        return len(segments)
+
+    def remove(self):
+        """Remove the partition from disk"""
+
+        self.segments = []
+        inThread(shutil.rmtree, self.path)
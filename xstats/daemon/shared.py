@@ -1,8 +1,17 @@
 from functools import partial
 from twiggy import quickSetup, levels
 
+import bisect
+import hashlib
+import random
+import struct
+import sys
+import threading
+import time
 import yaml
 
+import gevent
+
 def setup_logging(level = 'DEBUG', file = None):
     """
     Initialize the logging
@@ -55,6 +64,42 @@ def loadModulesFromConfig(config, host, finder):
             # Add to module host
             host.addModule(module)
 
+def inThread(function, *args):
+    """
+    Run `function` in a thread, for blocking work like file I/O. The
+    calling greenlet waits for it without blocking the others.
+
+    :returns: What `function` returned, what it raised is raised here
+    """
+
+    pool = getattr(gevent.get_hub(), "threadpool", None)
+    if pool is not None:
+        return pool.apply(function, args)
+
+    # gevent 0.13 has no threadpool, wait for a plain thread by polling
+    result = []
+
+    def run():
+        try:
+            result.append((True, function(*args)))
+        except Exception:
+            result.append((False, sys.exc_info()))
+
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+
+    delay = 0.001
+    while thread.is_alive():
+        gevent.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+    success, value = result[0]
+    if not success:
+        raise value[0], value[1], value[2]
+
+    return value
+
 class BasePublisher(object):
     def __init__(self):
         self.modules = []
@@ -65,3 +110,168 @@ class BasePublisher(object):
 
     def addModule(self, module):
         self.modules.append(module)
+
+class Backoff(object):
+    """Exponential backoff, optionally with full jitter"""
+
+    def __init__(self, initial = 1, maximum = 60, factor = 2, jitter = False):
+        """
+        :initial: Delay after the first failure, in seconds
+        :maximum: Upper bound for the delay
+        :factor:  Multiplier applied after every failure
+        :jitter:  Pick a random delay between 0 and the computed one
+        """
+
+        self.initial = initial
+        self.maximum = maximum
+        self.factor  = factor
+        self.jitter  = jitter
+
+        self.attempts = 0
+
+    def delay(self):
+        """
+        Get the delay for the next attempt, growing it for the one after
+
+        :returns: Delay in seconds
+        """
+
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+
+        if self.jitter:
+            delay = random.uniform(0, delay)
+
+        return delay
+
+    def reset(self):
+        """Start over from the initial delay"""
+
+        self.attempts = 0
+
+class CircuitBreaker(object):
+    """
+    Stops calling a failing dependency. After a failure calls aren't allowed
+    until the `backoff` delay has passed, then a single trial is let through
+    which either closes the breaker again or reopens it for longer.
+    """
+
+    def __init__(self, backoff = None):
+        """
+        :backoff: `Backoff` to get the open periods from
+        """
+
+        self.backoff   = backoff or Backoff()
+        self.openUntil = None
+
+    def isOpen(self):
+        """Whether the dependency is considered down"""
+
+        return self.openUntil is not None
+
+    def allow(self):
+        """Whether a call should be made now"""
+
+        return self.openUntil is None or time.time() >= self.openUntil
+
+    def success(self):
+        """Record a successful call, closing the breaker"""
+
+        self.openUntil = None
+        self.backoff.reset()
+
+    def failure(self):
+        """
+        Record a failed call, opening the breaker
+
+        :returns: Seconds until the next trial
+        """
+
+        delay = self.backoff.delay()
+        self.openUntil = time.time() + delay
+
+        return delay
+
+class TokenBucket(object):
+    """Allows `rate` events per second on average, bursts of up to `burst`"""
+
+    def __init__(self, rate, burst = None):
+        """
+        :rate:  Events per second
+        :burst: Events allowed at once, defaults to `rate`
+        """
+
+        self.rate   = float(rate)
+        self.burst  = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+
+        self.updated = time.time()
+
+    def take(self):
+        """
+        Take a token if there is one
+
+        :returns: Whether the event is allowed
+        """
+
+        now = time.time()
+
+        self.tokens  = min(self.burst,
+                           self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+class HashRing(object):
+    """
+    Consistent hash ring with virtual nodes, adding or removing a node only
+    moves the keys of about 1/N of the ring.
+    """
+
+    def __init__(self, nodes, replicas = 100):
+        """
+        :nodes:    Node names
+        :replicas: Virtual nodes per node, more spreads keys more evenly
+        """
+
+        self.nodes = list(nodes)
+
+        # Sorted (hash, node) of every virtual node
+        self.ring = sorted(
+            (self.hash("{}#{}".format(node, replica)), node)
+                for node in self.nodes
+                    for replica in xrange(replicas)
+        )
+        self.hashes = [point for point, _ in self.ring]
+
+    def hash(self, key):
+        return struct.unpack("!I", hashlib.md5(key).digest()[:4])[0]
+
+    def preference(self, key):
+        """
+        Get the nodes in the order `key` should use them, the first is its
+        primary and the others are the failovers in ring order
+
+        :returns: List of node names
+        """
+
+        if not self.ring:
+            return []
+
+        start = bisect.bisect(self.hashes, self.hash(key))
+
+        nodes = []
+        for index in xrange(len(self.ring)):
+            node = self.ring[(start + index) % len(self.ring)][1]
+
+            if node not in nodes:
+                nodes.append(node)
+
+                if len(nodes) == len(self.nodes):
+                    break
+
+        return nodes
@@ -0,0 +1,473 @@
+import mmap
+import os
+import struct
+
+from collections import deque
+
+import ujson
+
+from gevent.event import Event
+
+from twiggy import log; logger = log.name(__name__)
+
+class OutageSpool(object):
+    """
+    FIFO buffer for riding out outages. The oldest entries are kept in
+    memory up to `memoryLimit` bytes, anything beyond that is appended to a
+    file on disk. Entries have to be JSON encodable.
+
+    Reading is two-phase, `peek` returns the oldest entries and `commit`
+    removes them once they have been handled, so nothing is lost if
+    handling them fails.
+    """
+
+    def __init__(self, path, memoryLimit = 16 * 1024 * 1024,
+                 fileLimit = 1024 * 1024 * 1024):
+        """
+        :path:        File to spill to, entries left by a previous run are
+                      picked up again
+        :memoryLimit: Bytes of (encoded) entries to keep in memory
+        :fileLimit:   Bytes to allow in the file, newer entries are dropped
+                      once it's full
+        """
+
+        self.path        = path
+        self.memoryLimit = memoryLimit
+        self.fileLimit   = fileLimit
+
+        self.memory     = deque()
+        self.memorySize = 0
+
+        # Entries in the file and the offset of the oldest one
+        self.spilled    = 0
+        self.readOffset = 0
+        self.fileSize   = 0
+        self.writer     = None
+
+        # Line sizes of the file entries returned by the last `peek`
+        self.peekedSizes = []
+
+        self.dropped = 0
+        self.corrupt = 0
+
+        self.log = logger.name("spool").fields(path = path)
+
+        if os.path.exists(path):
+            with open(path, "r+b") as spoolFile:
+                for line in spoolFile:
+                    if not line.endswith("\n"):
+                        # Cut off mid-write, later entries would be
+                        # appended to it
+                        spoolFile.truncate(self.fileSize)
+                        self.log.warning("Truncated a partial entry")
+                        break
+
+                    self.spilled  += 1
+                    self.fileSize += len(line)
+
+            if self.spilled:
+                self.log.info("Picked up {} spooled entries", self.spilled)
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
+
+    def append(self, entry):
+        """
+        Add `entry` to the end of the spool
+
+        :entry: JSON encodable entry
+        """
+
+        line = "{}\n".format(ujson.dumps(entry))
+
+        # Once spilling, everything goes to the file to keep the order
+        if not self.spilled and self.memorySize + len(line) <= self.memoryLimit:
+            self.memory.append(line)
+            self.memorySize += len(line)
+            return
+
+        if self.fileSize + len(line) > self.fileLimit:
+            self.dropped += 1
+            return
+
+        if self.writer is None:
+            self.writer = open(self.path, "ab")
+
+        # Unbuffered, so entries survive a crash and `peek` can see them
+        self.writer.write(line)
+        self.writer.flush()
+
+        self.fileSize += len(line)
+        self.spilled  += 1
+
+    def peek(self, count):
+        """
+        Get up to `count` of the oldest entries, without removing them
+
+        :returns: List of entries
+        """
+
+        entries = [ujson.loads(line)
+                        for line, _ in zip(self.memory, xrange(count))]
+
+        self.peekedSizes = []
+
+        if len(entries) < count and self.spilled:
+            with open(self.path, "rb") as spoolFile:
+                spoolFile.seek(self.readOffset)
+
+                while len(entries) < count:
+                    line = spoolFile.readline()
+                    if not line:
+                        break
+
+                    try:
+                        entries.append(ujson.loads(line))
+                    except ValueError:
+                        # Left for the next `peek` if there's something
+                        # before it that still has to be committed
+                        if self.peekedSizes:
+                            break
+
+                        self._skip(line)
+                        continue
+
+                    self.peekedSizes.append(len(line))
+
+            # Nothing but corrupt lines left
+            if self.readOffset and not self.spilled:
+                self.clearFile()
+
+        return entries
+
+    def _skip(self, line):
+        """Drop the corrupt oldest file entry, e.g. from a full disk"""
+
+        self.log.warning("Skipping corrupt entry: {!r}", line[:64])
+
+        self.readOffset += len(line)
+        self.spilled    -= 1
+        self.corrupt    += 1
+
+    def commit(self, count):
+        """
+        Remove the `count` oldest entries, as returned by `peek`
+        """
+
+        while count and self.memory:
+            self.memorySize -= len(self.memory.popleft())
+            count -= 1
+
+        for size in self.peekedSizes[:count]:
+            self.readOffset += size
+            self.spilled    -= 1
+
+        self.peekedSizes = []
+
+        # File fully replayed, start over
+        if self.readOffset and not self.spilled:
+            self.clearFile()
+
+    def clearFile(self):
+        """Remove the spill file"""
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.readOffset = 0
+        self.fileSize   = 0
+
+class RingFile(object):
+    """
+    Fixed size, memory-mapped ring buffer of records on disk. When a new
+    record doesn't fit the oldest records are evicted to make room.
+
+    Layout: a header (magic, head, tail, count) followed by the data area.
+    A record is a uint32 length followed by the payload, a length of
+    `WRAP` (or no room for a length) means the data continues at the start
+    of the data area.
+    """
+
+    MAGIC = 0x58535231 # XSR1
+    WRAP  = 0xFFFFFFFF
+
+    header = struct.Struct("!IQQQ")
+    length = struct.Struct("!I")
+
+    def __init__(self, path, size):
+        """
+        :path: File to use, records left by a previous run are picked up
+        :size: Size of the file in bytes
+        """
+
+        self.path      = path
+        self.size      = size
+        self.dataStart = self.header.size
+
+        self.evicted = 0
+
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+
+        self.file = open(path, "r+b" if not fresh else "w+b")
+        if fresh:
+            self.file.truncate(size)
+
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        magic, head, tail, count = self.header.unpack_from(self.map, 0)
+
+        if fresh or magic != self.MAGIC:
+            head = tail = self.dataStart
+            count = 0
+
+        self.head  = head
+        self.tail  = tail
+        self.count = count
+
+        self._writeHeader()
+
+    def __len__(self):
+        return self.count
+
+    def _writeHeader(self):
+        self.header.pack_into(self.map, 0, self.MAGIC, self.head, self.tail,
+                              self.count)
+
+    def _record(self, offset):
+        """
+        Follow a possible wrap at `offset`
+
+        :returns: (offset of the record, payload length)
+        """
+
+        if offset + self.length.size > self.size:
+            offset = self.dataStart
+
+        size = self.length.unpack_from(self.map, offset)[0]
+
+        if size == self.WRAP:
+            offset = self.dataStart
+            size   = self.length.unpack_from(self.map, offset)[0]
+
+        return offset, size
+
+    def _room(self, needed):
+        """
+        Make `tail` point at `needed` contiguous free bytes if possible
+
+        :returns: Whether there is room
+        """
+
+        if self.count == 0:
+            self.head = self.tail = self.dataStart
+            return needed <= self.size - self.dataStart
+
+        if self.tail > self.head:
+            if self.size - self.tail >= needed:
+                return True
+
+            # Wrap around, if there's room before the oldest record
+            if self.dataStart + needed > self.head:
+                return False
+
+            if self.tail + self.length.size <= self.size:
+                self.length.pack_into(self.map, self.tail, self.WRAP)
+
+            self.tail = self.dataStart
+            return True
+
+        # Wrapped, the free space is between tail and head
+        return self.head - self.tail >= needed
+
+    def append(self, payload):
+        """
+        Append a record, evicting the oldest ones if needed
+
+        :payload: String to store
+        :returns: False if the record can never fit
+        """
+
+        needed = self.length.size + len(payload)
+
+        if needed > self.size - self.dataStart:
+            return False
+
+        while not self._room(needed):
+            self.pop()
+            self.evicted += 1
+
+        self.length.pack_into(self.map, self.tail, len(payload))
+        self.map[self.tail + self.length.size:self.tail + needed] = payload
+
+        self.tail  += needed
+        self.count += 1
+
+        self._writeHeader()
+        return True
+
+    def pop(self):
+        """Remove the oldest record"""
+
+        if not self.count:
+            return
+
+        offset, size = self._record(self.head)
+
+        self.head   = offset + self.length.size + size
+        self.count -= 1
+
+        if not self.count:
+            self.head = self.tail = self.dataStart
+
+        self._writeHeader()
+
+    def records(self, limit):
+        """
+        Get up to `limit` of the oldest records, without removing them
+
+        :returns: List of payloads
+        """
+
+        payloads = []
+        offset   = self.head
+
+        for _ in xrange(min(limit, self.count)):
+            offset, size = self._record(offset)
+            start = offset + self.length.size
+
+            payloads.append(self.map[start:start + size])
+            offset = start + size
+
+        return payloads
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+class SendSpool(object):
+    """
+    In-order send buffer for a `network.Session`.
+
+    Holds up to `memoryLimit` packets in memory, older ones overflow into
+    an optional `RingFile` (which evicts the oldest when full) or are
+    dropped without one. Reading is two-phase like `OutageSpool`, packets
+    are only removed once `commit` confirms they were sent.
+    """
+
+    record = struct.Struct("!Q")
+
+    # Method to call after packets were dropped or evicted
+    # if None don't call
+    dropHandler = None
+
+    def __init__(self, memoryLimit = None, ring = None):
+        """
+        :memoryLimit: Packets to keep in memory, None for no limit
+        :ring:        `RingFile` for packets beyond `memoryLimit`
+        """
+
+        self.memoryLimit = memoryLimit
+        self.ring        = ring
+
+        # (sequence, packet), sequence numbers keep increasing so `commit`
+        # can't remove anything that wasn't peeked
+        self.memory   = deque()
+        self.sequence = 0
+
+        self.dropped = 0
+
+        self.available = Event()
+
+        if ring is not None and len(ring):
+            # Continue numbering after what a previous run left behind
+            payload = ring.records(ring.count)[-1]
+            self.sequence = self.record.unpack_from(payload)[0] + 1
+
+    def __len__(self):
+        return len(self.memory) + (len(self.ring) if self.ring else 0)
+
+    def append(self, packet):
+        """
+        Add `packet` to the end of the spool
+
+        :packet: Packet to send
+        """
+
+        self.memory.append((self.sequence, packet))
+        self.sequence += 1
+
+        if self.memoryLimit is not None:
+            lost = self.dropped + self.evicted()
+
+            while len(self.memory) > self.memoryLimit:
+                sequence, oldest = self.memory.popleft()
+
+                if self.ring is None or not self.ring.append(
+                        self.record.pack(sequence) + ujson.dumps(oldest)):
+                    self.dropped += 1
+
+            if self.dropHandler and self.dropped + self.evicted() != lost:
+                self.dropHandler()
+
+        self.available.set()
+
+    def wait(self):
+        """Wait until there's something to send"""
+
+        while not len(self):
+            self.available.clear()
+            self.available.wait()
+
+    def peek(self, count):
+        """
+        Get up to `count` of the oldest packets, without removing them
+
+        :returns: (sequence of the last packet, list of packets)
+        """
+
+        entries = []
+
+        if self.ring is not None:
+            for payload in self.ring.records(count):
+                entries.append((self.record.unpack_from(payload)[0],
+                                ujson.loads(payload[self.record.size:])))
+
+        for entry in self.memory:
+            if len(entries) >= count:
+                break
+
+            entries.append(entry)
+
+        if not entries:
+            return None, []
+
+        return entries[-1][0], [packet for _, packet in entries]
+
+    def commit(self, sequence):
+        """
+        Remove all packets up to and including `sequence`
+        """
+
+        if sequence is None:
+            return
+
+        if self.ring is not None:
+            while len(self.ring):
+                payload = self.ring.records(1)[0]
+                if self.record.unpack_from(payload)[0] > sequence:
+                    break
+
+                self.ring.pop()
+
+        while self.memory and self.memory[0][0] <= sequence:
+            self.memory.popleft()
+
+    def evicted(self):
+        """Packets evicted from the ring file so far"""
+
+        return self.ring.evicted if self.ring is not None else 0
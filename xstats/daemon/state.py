@@ -0,0 +1,128 @@
+class Schema(object):
+    """
+    Key layout of a module's data, shared by every record with the same
+    set of keys so the keys are only stored once.
+    """
+
+    __slots__ = ('keys', 'positions')
+
+    def __init__(self, keys):
+        self.keys      = keys
+        self.positions = dict((key, index) for index, key in enumerate(keys))
+
+    def fits(self, data):
+        """Whether `data` has exactly the keys of this schema"""
+
+        if len(data) != len(self.keys):
+            return False
+
+        positions = self.positions
+        for key in data:
+            if key not in positions:
+                return False
+
+        return True
+
+class Record(object):
+    """Latest values of a single host/module"""
+
+    __slots__ = ('timestamp', 'schema', 'values')
+
+    def __init__(self, timestamp, schema, values):
+        self.timestamp = timestamp
+        self.schema    = schema
+        self.values    = values
+
+    def data(self):
+        """Get the values as a new dictionary"""
+
+        return dict(zip(self.schema.keys, self.values))
+
+class LatestStore(object):
+    """
+    Latest data of every host/module.
+
+    Records only hold a timestamp, a reference to a shared `Schema` and a
+    list of values, so memory use is predictable: roughly 150 bytes plus 8
+    bytes per key for every host/module, plus the values themselves.
+    """
+
+    def __init__(self):
+        # (host, module) -> `Record`
+        self.records = {}
+
+        # Sorted tuple of keys -> `Schema`
+        self.schemas = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def schema(self, data):
+        """Get the shared schema for the keys of `data`"""
+
+        keys = tuple(sorted(data))
+
+        schema = self.schemas.get(keys)
+        if schema is None:
+            schema = self.schemas[keys] = Schema(keys)
+
+        return schema
+
+    def update(self, host, module, timestamp, data):
+        """
+        Store `data` as the latest data of `host`/`module`
+
+        :data: Complete data of the module
+        """
+
+        record = self.records.get((host, module))
+
+        if record is not None and record.schema.fits(data):
+            positions = record.schema.positions
+
+            for key, value in data.iteritems():
+                record.values[positions[key]] = value
+
+            record.timestamp = timestamp
+            return
+
+        schema = self.schema(data)
+        values = [data[key] for key in schema.keys]
+
+        if record is None:
+            self.records[(host, module)] = Record(timestamp, schema, values)
+        else:
+            record.timestamp = timestamp
+            record.schema    = schema
+            record.values    = values
+
+    def get(self, host, module):
+        """
+        Get the latest data of `host`/`module`
+
+        :returns: New dictionary, None if nothing is stored
+        """
+
+        record = self.records.get((host, module))
+        if record is None:
+            return None
+
+        return record.data()
+
+    def remove(self, host, module):
+        self.records.pop((host, module), None)
+
+    def snapshot(self, matches = None):
+        """
+        Get the latest data as packets
+
+        :matches: Callable taking (host, module), to filter what's included
+        :returns: List of packets
+        """
+
+        return [
+            {"host": host, "module": module, "timestamp": record.timestamp,
+             "data": record.data()}
+                for (host, module), record in self.records.iteritems()
+                    if matches is None or matches(host, module)
+        ]
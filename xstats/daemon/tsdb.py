@@ -0,0 +1,346 @@
+"""
+Compressed in-memory time series, following the Gorilla paper (Pelkonen et
+al., VLDB 2015). Timestamps are stored as delta-of-deltas and values as
+the XOR with the previous value, so a regular 1 Hz series of slowly
+changing values takes one or two bytes per point.
+"""
+
+import struct
+
+double = struct.Struct("!d")
+uint64 = struct.Struct("!Q")
+
+# Delta-of-delta ranges: (prefix, prefix bits, value bits), the value is
+# stored with an offset so it's never negative
+timestampRanges = (
+    (0b10,   2, 7),
+    (0b110,  3, 9),
+    (0b1110, 4, 12),
+)
+
+class BitWriter(object):
+    """Appends bits to a bytearray"""
+
+    __slots__ = ('data', 'current', 'bits')
+
+    def __init__(self):
+        self.data    = bytearray()
+        self.current = 0
+        self.bits    = 0
+
+    def write(self, value, count):
+        """Append the lowest `count` bits of `value` (not negative)"""
+
+        self.current = (self.current << count) | value
+        self.bits   += count
+
+        while self.bits >= 8:
+            self.bits -= 8
+            self.data.append((self.current >> self.bits) & 0xFF)
+
+        self.current &= (1 << self.bits) - 1
+
+    def getvalue(self):
+        """Bytes written so far, the last one padded with zeros"""
+
+        if not self.bits:
+            return str(self.data)
+
+        return str(self.data) + chr((self.current << (8 - self.bits)) & 0xFF)
+
+class BitReader(object):
+    """Reads bits from a string"""
+
+    __slots__ = ('data', 'position')
+
+    def __init__(self, data):
+        self.data     = data
+        self.position = 0
+
+    def read(self, count):
+        value    = 0
+        position = self.position
+        data     = self.data
+
+        while count:
+            byte   = ord(data[position >> 3])
+            offset = position & 7
+            take   = min(8 - offset, count)
+
+            value = (value << take) | \
+                    ((byte >> (8 - offset - take)) & ((1 << take) - 1))
+
+            position += take
+            count    -= take
+
+        self.position = position
+        return value
+
+    def bit(self):
+        return self.read(1)
+
+class Chunk(object):
+    """Sealed, read only block of points"""
+
+    __slots__ = ('start', 'end', 'count', 'data')
+
+    def __init__(self, start, end, count, data):
+        self.start = start
+        self.end   = end
+        self.count = count
+        self.data  = data
+
+    def __iter__(self):
+        return decode(self.data, self.count)
+
+class Series(object):
+    """
+    Points of a single metric, as sealed `Chunk`s of `chunkSize` points and
+    the chunk being written
+    """
+
+    __slots__ = ('chunkSize', 'chunks', 'writer', 'count', 'start',
+                 'timestamp', 'delta', 'value', 'leading', 'trailing')
+
+    def __init__(self, chunkSize = 1024):
+        self.chunkSize = chunkSize
+        self.chunks    = []
+
+        self._reset()
+
+    def _reset(self):
+        self.writer    = BitWriter()
+        self.count     = 0
+        self.start     = None
+        self.timestamp = None
+        self.delta     = 0
+        self.value     = 0
+        self.leading   = 64
+        self.trailing  = 0
+
+    def last(self):
+        """Timestamp of the newest point, None if there is none"""
+
+        if self.timestamp is not None:
+            return self.timestamp
+
+        return self.chunks[-1].end if self.chunks else None
+
+    def append(self, timestamp, value):
+        """
+        Add a point
+
+        :timestamp: Integer unix timestamp, newer than the last point
+        :value:     Number
+        :returns: False if the point was dropped for being out of order
+        """
+
+        last = self.last()
+        if last is not None and timestamp <= last:
+            return False
+
+        writer = self.writer
+        bits   = uint64.unpack(double.pack(value))[0]
+
+        if self.count == 0:
+            # Header: first timestamp and raw value
+            writer.write(timestamp & 0xFFFFFFFF, 32)
+            writer.write(bits, 64)
+
+            self.start = timestamp
+        else:
+            delta = timestamp - self.timestamp
+            self._writeTimestamp(delta - self.delta)
+            self._writeValue(bits ^ self.value)
+
+            self.delta = delta
+
+        self.timestamp = timestamp
+        self.value     = bits
+        self.count    += 1
+
+        if self.count >= self.chunkSize:
+            self.seal()
+
+        return True
+
+    def _writeTimestamp(self, deltaOfDelta):
+        writer = self.writer
+
+        if deltaOfDelta == 0:
+            writer.write(0, 1)
+            return
+
+        for prefix, prefixBits, valueBits in timestampRanges:
+            offset = 1 << (valueBits - 1)
+
+            if -offset < deltaOfDelta <= offset:
+                writer.write(prefix, prefixBits)
+                writer.write(deltaOfDelta + offset - 1, valueBits)
+                return
+
+        writer.write(0b1111, 4)
+        writer.write(deltaOfDelta & 0xFFFFFFFF, 32)
+
+    def _writeValue(self, xor):
+        writer = self.writer
+
+        if xor == 0:
+            writer.write(0, 1)
+            return
+
+        leading  = min(31, 64 - xor.bit_length())
+        trailing = (xor & -xor).bit_length() - 1
+
+        if leading >= self.leading and trailing >= self.trailing:
+            # Fits the previous window
+            writer.write(0b10, 2)
+            writer.write(xor >> self.trailing,
+                         64 - self.leading - self.trailing)
+            return
+
+        meaningful = 64 - leading - trailing
+
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        writer.write(meaningful & 63, 6)
+        writer.write(xor >> trailing, meaningful)
+
+        self.leading  = leading
+        self.trailing = trailing
+
+    def seal(self):
+        """Close the chunk being written, if it has any points"""
+
+        if not self.count:
+            return
+
+        self.chunks.append(Chunk(self.start, self.timestamp, self.count,
+                                 self.writer.getvalue()))
+
+        # The next chunk starts fresh, `last` now comes from the chunk
+        self._reset()
+
+    def expire(self, before):
+        """Drop sealed chunks that only hold points older than `before`"""
+
+        while self.chunks and self.chunks[0].end < before:
+            self.chunks.pop(0)
+
+    def points(self, start = None, end = None):
+        """
+        Get the points between `start` and `end`, inclusive
+
+        :returns: Generator of (timestamp, value)
+        """
+
+        blocks = [(chunk.start, chunk.end, chunk) for chunk in self.chunks]
+
+        if self.count:
+            blocks.append((self.start, self.timestamp,
+                           decode(self.writer.getvalue(), self.count)))
+
+        for first, last, points in blocks:
+            if (end is not None and first > end) or \
+               (start is not None and last < start):
+                continue
+
+            for timestamp, value in points:
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    break
+
+                yield timestamp, value
+
+    def size(self):
+        """Bytes of compressed data"""
+
+        return sum(len(chunk.data) for chunk in self.chunks) + \
+               len(self.writer.data)
+
+def decode(data, count):
+    """
+    Decode `count` points of a chunk
+
+    :returns: Generator of (timestamp, value)
+    """
+
+    reader = BitReader(data)
+
+    timestamp = reader.read(32)
+    bits      = reader.read(64)
+    delta     = 0
+    leading   = 0
+    trailing  = 0
+
+    yield timestamp, double.unpack(uint64.pack(bits))[0]
+
+    for _ in xrange(count - 1):
+        # Timestamp
+        if reader.bit():
+            for prefix, prefixBits, valueBits in timestampRanges:
+                if not reader.bit():
+                    offset = 1 << (valueBits - 1)
+                    delta += reader.read(valueBits) - offset + 1
+                    break
+            else:
+                deltaOfDelta = reader.read(32)
+                if deltaOfDelta & 0x80000000:
+                    deltaOfDelta -= 0x100000000
+
+                delta += deltaOfDelta
+
+        timestamp += delta
+
+        # Value
+        if reader.bit():
+            if reader.bit():
+                leading    = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing   = 64 - leading - meaningful
+
+            bits ^= reader.read(64 - leading - trailing) << trailing
+
+        yield timestamp, double.unpack(uint64.pack(bits))[0]
+
+def downsample(points, step, aggregate = "avg"):
+    """
+    Aggregate points into `step` second buckets
+
+    :points:    Iterable of (timestamp, value), in order
+    :aggregate: One of avg, min, max, sum, count, last
+    :returns: List of (bucket start, aggregated value)
+    """
+
+    functions = {
+        "avg"  : lambda values: sum(values) / len(values),
+        "min"  : min,
+        "max"  : max,
+        "sum"  : sum,
+        "count": len,
+        "last" : lambda values: values[-1],
+    }
+
+    function = functions[aggregate]
+
+    result = []
+    bucket = None
+    values = []
+
+    for timestamp, value in points:
+        start = timestamp - timestamp % step
+
+        if start != bucket:
+            if values:
+                result.append((bucket, function(values)))
+
+            bucket = start
+            values = []
+
+        values.append(value)
+
+    if values:
+        result.append((bucket, function(values)))
+
+    return result
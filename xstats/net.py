@@ -1,55 +1,194 @@
+import math
 import psutil
 import time
 
 from collections import deque
 
-def get_network_avg(attributes = None, sample_time = 1, interface = None):
+def calculate_rates(old_sample, new_sample, elapsed, attributes):
     """
-    Get the average of a network related `attributes` for a
-    specified `sample_time`
+    Calculate the per second rate of `attributes` between two counter
+    snapshots (namedtuples) that were taken `elapsed` seconds apart.
 
-    Will show results for all interfaces or for `interface`.
+    :returns: List of rates, in the same order as `attributes`
+    """
 
-    :returns: List (attribute1, attribute2)
+    return [(getattr(new_sample, attribute) - getattr(old_sample, attribute))
+                / float(elapsed) for attribute in attributes]
+
+def get_network_counters(interface = None):
     """
+    Snapshot the network counters for all interfaces combined or for
+    `interface`.
 
-    if not attributes:
-        attributes = ('bytes_sent', 'bytes_recv',
-                      'packets_sent', 'packets_recv')
+    :returns: Namedtuple as returned by `psutil.network_io_counters`
+    """
+
+    # Only fetch per interface if we are checking a specific interface.
+    counters = psutil.network_io_counters(interface != None)
+    if interface:
+        counters = counters[interface]
+
+    return counters
+
+class RollingWindow(object):
+    """
+    Window over the last `size` samples of a stream.
+
+    Keeps a running sum for the average and monotonic deques for the
+    minimum/maximum, so every update is O(1) (amortized) regardless of the
+    window size.
+    """
 
-    def calculate_average(attribute, old_values, new_values):
+    def __init__(self, size):
         """
-        Calculate the average for `attribute` fetching it from
-        the old_values/new_values namedtuples.
+        :size: Number of samples in the window
+        """
+
+        self.size    = size
+        self.samples = deque()
+        self.total   = 0.0
 
-        :returns: Average value for 1 second for `attribute`
+        # Number of samples appended so far, used to expire min/max entries
+        self.count = 0
+
+        # (index, value) pairs with increasing/decreasing values, the front
+        # is the minimum/maximum of the current window
+        self.minimums = deque()
+        self.maximums = deque()
+
+    def append(self, value):
+        """
+        Add `value` to the window, dropping the oldest sample if full
         """
 
-        # Calculate differences
-        old_value = getattr(old_values, attribute)
-        new_value = getattr(new_values, attribute)
+        index       = self.count
+        self.count += 1
 
-        attr_difference = new_value - old_value
+        self.samples.append(value)
+        self.total += value
 
-        # Get actual throughput/s
-        attr_second = attr_difference / sample_time
+        if len(self.samples) > self.size:
+            self.total -= self.samples.popleft()
 
-        return attr_second
+        # Running float sums drift, re-sum once per window which keeps the
+        # cost amortized O(1)
+        if self.count % self.size == 0:
+            self.total = math.fsum(self.samples)
 
-    # Fetch network_io_counters, only fetch per inteface if we are checking
-    # a specific inteface.
-    start_sample = psutil.network_io_counters(interface != None)
-    if interface:
-        start_sample = start_sample[interface]
+        # Expire entries that fell out of the window
+        oldest = self.count - len(self.samples)
+        while self.minimums and self.minimums[0][0] < oldest:
+            self.minimums.popleft()
+        while self.maximums and self.maximums[0][0] < oldest:
+            self.maximums.popleft()
 
-    time.sleep(sample_time)
+        # Values dominated by the new one can never be the min/max again
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
 
-    end_sample = psutil.network_io_counters(interface != None)
-    if interface:
-        end_sample = end_sample[interface]
+        self.minimums.append((index, value))
+        self.maximums.append((index, value))
+
+    def average(self):
+        """Average of the samples in the window, None if empty"""
+
+        if not self.samples:
+            return None
+
+        return self.total / len(self.samples)
+
+    def minimum(self):
+        """Smallest sample in the window, None if empty"""
+
+        return self.minimums[0][1] if self.minimums else None
+
+    def maximum(self):
+        """Largest sample in the window, None if empty"""
+
+        return self.maximums[0][1] if self.maximums else None
+
+class Ewma(object):
+    """Exponentially weighted moving average"""
+
+    def __init__(self, alpha):
+        """
+        :alpha: Weight of a new sample, between 0 and 1
+        """
+
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        """Fold `sample` into the average and return the new value"""
 
-    return [calculate_average(attribute, start_sample, end_sample)
-                for attribute in attributes]
+        if self.value is None:
+            self.value = float(sample)
+        else:
+            self.value += self.alpha * (sample - self.value)
+
+        return self.value
+
+class RollingStats(object):
+    """
+    Rolling window statistics and EWMAs for a fixed set of attributes, fed
+    with one list of values (one per attribute) per tick.
+    """
+
+    def __init__(self, attributes, sample_num = 30, alpha = 0.2):
+        """
+        :attributes: Names of the attributes to track
+        :sample_num: Number of samples in the rolling window
+        :alpha:      Weight of a new sample in the EWMA
+        """
+
+        self.attributes = tuple(attributes)
+        self.windows    = [RollingWindow(sample_num) for _ in self.attributes]
+        self.ewmas      = [Ewma(alpha) for _ in self.attributes]
+
+    def update(self, values):
+        """
+        Add one sample for every attribute
+
+        :values: Values in the same order as `attributes`
+        """
+
+        for window, ewma, value in zip(self.windows, self.ewmas, values):
+            window.append(value)
+            ewma.update(value)
+
+    def averages(self):
+        return [window.average() for window in self.windows]
+
+    def minimums(self):
+        return [window.minimum() for window in self.windows]
+
+    def maximums(self):
+        return [window.maximum() for window in self.windows]
+
+    def ewma(self):
+        return [ewma.value for ewma in self.ewmas]
+
+def get_network_avg(attributes = None, sample_time = 1, interface = None):
+    """
+    Get the average of a network related `attributes` for a
+    specified `sample_time`
+
+    Will show results for all interfaces or for `interface`.
+
+    :returns: List (attribute1, attribute2)
+    """
+
+    if not attributes:
+        attributes = ('bytes_sent', 'bytes_recv',
+                      'packets_sent', 'packets_recv')
+
+    start_sample = get_network_counters(interface)
+    time.sleep(sample_time)
+    end_sample = get_network_counters(interface)
+
+    return calculate_rates(start_sample, end_sample, sample_time, attributes)
 
 def get_network_throughput_avg(sample_time = 1, interface = None):
     """
@@ -67,22 +206,32 @@ def stream_network_throughput_rolling_avg(sample_num = 30, interval = 1, interfa
     """
     Stream a rolling network average by calling :callback: every tick
 
+    Both directions are calculated from the same pair of snapshots, and
+    every snapshot ends one window and starts the next one.
+
     :sample_num: Number of samples to average over
     :interval:   Interval between samples
     :interface: Interface, combined if None, specific interface if string.
     :callback:   Callable to invoke every tick with the result
     """
 
-    samples = (
-        deque(maxlen = sample_num),
-        deque(maxlen = sample_num)
-    )
+    attributes = ('bytes_sent', 'bytes_recv')
+    stats      = RollingStats(attributes, sample_num)
+
+    last_time   = time.time()
+    last_sample = get_network_counters(interface)
+
     while True:
-        for i in xrange(0, 2):
-            sample = get_network_throughput_avg(sample_time = interval, interface = interface)[i]
-            samples[i].append(sample)
+        time.sleep(interval)
+
+        now    = time.time()
+        sample = get_network_counters(interface)
+
+        stats.update(calculate_rates(last_sample, sample, now - last_time,
+                                     attributes))
 
-        averages = map(lambda sampleDeque: (sum(sampleDeque) / len(sampleDeque)), samples)
+        last_time   = now
+        last_sample = sample
 
         if callback:
-            callback(averages)
+            callback(stats.averages())
@@ -0,0 +1,56 @@
+"""
+Tests of the server side connection handling.
+
+    python -m unittest xstats.tests.test_network
+"""
+
+import unittest
+
+import gevent
+
+from gevent import socket
+
+from xstats.daemon import network
+
+class HandshakeTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        # Never started, connections are handed to `handleConnect` directly
+        self.server = network.Server(0, maxHandshakes = 1,
+                                     handshakeTimeout = 0.2)
+
+    def connect(self):
+        """Connect a client, returns the client's end of the connection"""
+
+        server, client = socket.socketpair()
+        self.server.handleConnect(server, ("127.0.0.1", 0))
+
+        client.settimeout(2)
+        gevent.sleep(0.05)
+
+        return client
+
+    def testSilentClientDropped(self):
+        silent = self.connect()
+
+        self.assertEqual(self.server.handshaking, 1)
+        self.assertFalse(self.server.admit())
+
+        # Waits out the timeout, the server closes the connection
+        self.assertEqual(silent.recv(1), "")
+        gevent.sleep(0.05)
+
+        self.assertEqual(self.server.handshaking, 0)
+        self.assertEqual(len(self.server.sessions), 0)
+        self.assertTrue(self.server.admit())
+
+    def testClientInTimeKept(self):
+        client = self.connect()
+        client.sendall(network.JsonProtocol().encode({"Test": {"a": 1}}))
+
+        gevent.sleep(0.4)
+
+        self.assertEqual(self.server.handshaking, 0)
+        self.assertEqual(len(self.server.sessions), 1)
+
+if __name__ == "__main__":
+    unittest.main()